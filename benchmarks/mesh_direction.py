@@ -0,0 +1,79 @@
+"""Check mhd2polygon against vtkMetaImageReader on images with a direction.
+
+A label image with a flipped (as written by label2mhd) or rotated
+``TransformMatrix`` is meshed by ``polygon_converter.mesh_labels`` and by the
+original pipeline reading the image with vtkMetaImageReader, and the
+resulting points are compared. Fails if any mesh differs.
+
+    python benchmarks/mesh_direction.py
+"""
+import os
+import sys
+import tempfile
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ssrvtools import mhd
+from ssrvtools import polygon_converter as pc
+
+_transform_matrices = ['-1 0 0 0 -1 0 0 0 1', '0 1 0 -1 0 0 0 0 1']
+
+def _volume():
+    volume = np.zeros((30, 40, 50), dtype=np.uint8)
+    volume[3:12,5:20,6:25] = 1
+    volume[15:30,20:40,30:50] = 2
+    volume[0:5,30:38,0:9] = 3
+    return volume
+
+def _reference(filename, label, cap):
+    """Mesh a label as mhd2polygon did with vtkMetaImageReader."""
+    reader = vtk.vtkMetaImageReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    contour = vtk.vtkDiscreteMarchingCubes()
+    if cap:
+        padder = vtk.vtkImageConstantPad()
+        padder.SetInputConnection(reader.GetOutputPort())
+        padder.SetConstant(0)
+        extent = reader.GetOutput().GetExtent()
+        padder.SetOutputWholeExtent(-1, extent[1]+1, -1, extent[3]+1, -1, extent[5]+1)
+        contour.SetInputConnection(padder.GetOutputPort())
+    else:
+        contour.SetInputConnection(reader.GetOutputPort())
+    contour.ComputeNormalsOff()
+    contour.SetValue(0, label)
+    contour.Update()
+    return pc._simplify(contour.GetOutput(), 0.9, 10)
+
+def _points(polydata):
+    return numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+
+def main():
+    volume = _volume()
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'label.mha')
+        for transform_matrix in _transform_matrices:
+            mhd.write(filename, volume, {'TransformMatrix': transform_matrix, 'ElementSpacing': [0.5, 0.7, 1.3], 'Offset': [1, 2, 3]})
+            image, header = mhd.read(filename)
+            for cap in [False, True]:
+                for single_pass in [False, True]:
+                    meshes = pc.mesh_labels(image, header['ElementSpacing'], header['Offset'], cap=cap, single_pass=single_pass,
+                                            direction=pc.direction_matrix(header))
+                    for label, polydata in meshes.items():
+                        expected = _points(_reference(filename, label, cap))
+                        actual = _points(polydata)
+                        ok = expected.shape == actual.shape and np.allclose(expected, actual, atol=1e-4)
+                        if not ok:
+                            failed.append((transform_matrix, cap, single_pass, label))
+                        print('TransformMatrix = {:<20} cap={:<5} single_pass={:<5} label {} {}'.format(
+                            transform_matrix, str(cap), str(single_pass), label, 'ok' if ok else 'DIFFERS'))
+    if failed:
+        print('Meshes differ from vtkMetaImageReader:', failed)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Peak memory benchmark of mhd read/write.
+
+Each case runs in a fresh interpreter and the peak of memory allocated
+through Python and numpy (tracemalloc) is reported relative to the size
+of the image. For writes the image itself is excluded, so the ratio is
+the extra memory needed to write it. For reads the returned image is
+included, so 1.0 is the minimum.
+
+Single stream compressed data is (de)compressed by pylibdeflate when it
+is installed, which holds the whole compressed data and, when reading, a
+decompressed copy besides the image. Both the zlib and the pylibdeflate
+paths are measured; the latter is reported as n/a without pylibdeflate.
+
+    python benchmarks/mhd_memory.py --shape 256 512 512
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_cases = [
+    ('uncompressed', "{'CompressedData': False}", None),
+    ('single stream', "{'CompressedData': True}", None),
+    ('chunked', "{'CompressedData': True}", 8),
+]
+
+_write_code = '''
+import sys, tracemalloc
+{disable}
+sys.path.insert(0, {root!r})
+import numpy as np
+from ssrvtools import mhd
+image = np.random.RandomState(0).randint(0, 8, {shape!r}).astype(np.uint8)
+tracemalloc.start()
+mhd.write({filename!r}, image, {header}, chunk_slabs={chunk_slabs!r})
+print(tracemalloc.get_traced_memory()[1] / image.nbytes)
+'''
+
+_read_code = '''
+import sys, tracemalloc
+{disable}
+sys.path.insert(0, {root!r})
+import numpy as np
+from ssrvtools import mhd
+tracemalloc.start()
+image, _ = mhd.read({filename!r})
+print(tracemalloc.get_traced_memory()[1] / image.nbytes)
+'''
+
+def _run(code):
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return float(result.stdout.split()[-1])
+
+_disable_pylibdeflate = "sys.modules['pylibdeflate'] = None # import fails"
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak memory benchmark of mhd read/write.')
+    parser.add_argument('--shape', help='Shape of the image. Default:%(default)s',metavar='<n>',type=int,nargs='+',default=[128,512,512])
+    args = parser.parse_args()
+
+    try:
+        import pylibdeflate
+        pylibdeflate_code = '' # used when available
+    except ImportError:
+        pylibdeflate_code = None
+    shape = tuple(args.shape)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'image.mha')
+        for name, header, chunk_slabs in _cases:
+            backends = [('', '')]
+            if name == 'single stream': # the only case using pylibdeflate
+                backends = [(' (zlib)', _disable_pylibdeflate), (' (pylibdeflate)', pylibdeflate_code)]
+            for backend, disable in backends:
+                if disable is None:
+                    print('{:<28} n/a, pylibdeflate is not installed'.format(name + backend))
+                    continue
+                write = _run(_write_code.format(root=root, disable=disable, shape=shape, filename=filename, header=header, chunk_slabs=chunk_slabs))
+                read = _run(_read_code.format(root=root, disable=disable, filename=filename))
+                print('{:<28} write {:5.2f} x image, read {:5.2f} x image'.format(name + backend, write, read))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Surface extraction benchmark of polygon_converter.
+
+Compares the time to extract the surfaces of all labels of a synthetic
+volume with many labels by
+  - per-label: marching cubes over the whole volume once per label
+  - cropped: marching cubes over the bounding box of each label
+  - single-pass: marching cubes for all labels at once split by label
+Decimation and smoothing, which are the same for all, are not included.
+
+    python benchmarks/multilabel_meshing.py --size 128 --n_labels 300
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ssrvtools import polygon_converter as pc
+from ssrvtools import boundingbox as bb
+
+def _volume(size, n_labels, seed=0):
+    rng = np.random.RandomState(seed)
+    volume = np.zeros((size, size, size), dtype=np.uint16)
+    for label in range(1, n_labels + 1):
+        radius = rng.randint(3, 8)
+        center = rng.randint(radius, size - radius, 3)
+        slices = tuple(slice(c - radius, c + radius) for c in center)
+        volume[slices] = label
+    return volume
+
+def main():
+    parser = argparse.ArgumentParser(description='Surface extraction benchmark of polygon_converter.')
+    parser.add_argument('--size', help='Size of the volume. Default:%(default)s',metavar='<n>',type=int,default=128)
+    parser.add_argument('--n_labels', help='Number of labels. Default:%(default)s',metavar='<n>',type=int,default=300)
+    args = parser.parse_args()
+
+    volume = _volume(args.size, args.n_labels)
+    labels = [int(l) for l in np.unique(volume) if l != 0]
+    spacing = [1.0, 1.0, 1.0]
+    origin = [0.0, 0.0, 0.0]
+    image = pc.to_image_data(volume, spacing, origin)
+
+    start = time.perf_counter()
+    n_per_label = sum(pc._contour(image, [label]).GetNumberOfPolys() for label in labels)
+    per_label = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n_cropped = 0
+    for label, bbox in bb.label_bboxes(volume).items():
+        slices = bb._crop_slices(volume.shape, bbox, 1)
+        sub_origin = [s.start for s in slices][::-1]
+        n_cropped += pc._contour(pc.to_image_data(volume[slices], spacing, sub_origin), [label]).GetNumberOfPolys()
+    cropped = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pieces = pc._split_by_label(pc._contour(image, labels))
+    n_single = sum(len(triangles) for _, triangles in pieces.values())
+    single = time.perf_counter() - start
+
+    print('{} labels in {}^3 volume'.format(len(labels), args.size))
+    print('per-label   {:8.3f} s ({} triangles)'.format(per_label, n_per_label))
+    print('cropped     {:8.3f} s ({} triangles)'.format(cropped, n_cropped))
+    print('single-pass {:8.3f} s ({} triangles)'.format(single, n_single))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Startup time benchmark of ssrvtools commands.
+
+Each command is loaded (its module imported, nothing run) in a fresh
+interpreter several times and the fastest time is taken. Times are
+divided by the time to import numpy so that budgets do not depend on
+the machine much. The benchmark fails if a command exceeds its budget
+in startup_budget.json by more than the tolerance (relative, plus half a
+numpy import to absorb noise of fast commands). A command which fails to
+load also fails the benchmark, unless it is known to need an optional
+dependency which is not installed.
+
+    python benchmarks/startup.py            # check
+    python benchmarks/startup.py --update   # record the current times as budgets
+"""
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from ssrvtools.cli import commands
+
+# commands needing optional dependencies, which are skipped when the dependency is missing
+_optional_dependencies = {name: 'SimpleITK' for name in [
+    'coarse_rigid_registration', 'fine_rigid_registration',
+    'apply_rigid_transformations', 'apply_rigid_transformation', 'apply_inverse_rigid_transformation',
+    'nonrigid_registration', 'finalize_registration', 'manual_rigid_registration']}
+
+budget_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_budget.json')
+
+def _measure(code, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        best = elapsed if best is None else min(best, elapsed)
+    return best, None
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time benchmark of ssrvtools commands.')
+    parser.add_argument('--repeat', help='Number of runs per command. Default:%(default)s',metavar='<n>',type=int,default=5)
+    parser.add_argument('--tolerance', help='Allowed relative regression. Default:%(default)s',metavar='<ratio>',type=float,default=0.25)
+    parser.add_argument('--update', help='Write the current times into the budget file',action='store_true')
+    args = parser.parse_args()
+
+    empty, _ = _measure('pass', args.repeat)
+    reference, _ = _measure('import numpy', args.repeat)
+    unit = reference - empty
+    print('interpreter: {:.3f} s, numpy: {:.3f} s'.format(empty, unit))
+
+    budgets = {}
+    if os.path.exists(budget_filename):
+        with open(budget_filename) as f:
+            budgets = json.load(f)
+
+    ratios = {}
+    failed = []
+    broken = []
+    for name, _ in commands:
+        elapsed, error = _measure('from ssrvtools.cli import load; load({!r})'.format(name), args.repeat)
+        if elapsed is None:
+            dependency = _optional_dependencies.get(name)
+            if dependency is not None and importlib.util.find_spec(dependency) is None:
+                print('{:<36} skipped ({} is not installed)'.format(name, dependency))
+            else:
+                print('{:<36} FAILED ({})'.format(name, error))
+                broken.append(name)
+            continue
+        ratio = (elapsed - empty) / unit
+        ratios[name] = round(ratio, 2)
+        budget = budgets.get(name)
+        status = ''
+        if budget is not None and ratio > budget * (1 + args.tolerance) + 0.5:
+            status = 'REGRESSED (budget {:.2f})'.format(budget)
+            failed.append(name)
+        print('{:<36} {:.3f} s {:6.2f} x numpy {}'.format(name, elapsed - empty, ratio, status))
+
+    if broken:
+        print('Failed to load:', broken)
+        return 1
+    if args.update:
+        budgets.update(ratios)
+        with open(budget_filename, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+    if failed:
+        print('Startup time regressed:', failed)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,4 @@
+import sys
+from ssrvtools.cli import main
+
+sys.exit(main())
@@ -1,37 +1,63 @@
 # -*- coding: utf-8 -*-
+import os
+import json
+import operator
+import itertools
 import numpy as np
 
-def bbox(img):
+def bbox(img, n_slabs=64):
     """Compute bounding box for given ndarray.
 
+    The image is scanned once, ``n_slabs`` slabs (elements along the first
+    axis) at a time, so memory-maps and lazily loaded images (e.g.
+    ``mhd.LazyVolume``) are not loaded at once.
+
     Args:
         img (ndarray): Input image.
+        n_slabs (int): The number of slabs processed at once.
     Returns:
         (np.array, np.array): Bounding box of input image. (bbox_min, bbox_max)
     """
-    if np.count_nonzero(img) == 0:
+    first = None
+    last = None
+    projection = np.zeros(img.shape[1:], dtype=bool)
+    z = 0
+    for block in _iter_blocks(img, n_slabs):
+        block = np.asarray(block)
+        nonzero = block != 0
+        if nonzero.ndim > 1:
+            slabs = np.flatnonzero(np.any(nonzero.reshape((len(nonzero), -1)), axis=1))
+            projection |= np.any(nonzero, axis=0)
+        else:
+            slabs = np.flatnonzero(nonzero)
+        if len(slabs) > 0:
+            first = z + slabs[0] if first is None else first
+            last = z + slabs[-1]
+        z += len(block)
+    if first is None:
         raise ValueError('Input image is empty.')
-    dim = img.ndim
-    bb = np.array([np.where(np.any(img, axis=tuple([i for i in range(dim) if i != d])))[0][[0,-1]] for d in range(dim)])
+    dim = projection.ndim
+    bb = np.array([[first, last]] + [np.where(np.any(projection, axis=tuple([i for i in range(dim) if i != d])))[0][[0,-1]] for d in range(dim)])
     return bb[:,0],bb[:,1]
 
-def crop(image, bbox, margin=0):
+def _crop_slices(shape, bbox, margin):
+    bmin = np.maximum(0,np.asarray(bbox[0])-margin)
+    bmax = np.minimum(np.array(shape),np.asarray(bbox[1])+(margin+1))
+    return tuple(slice(int(lo), int(hi)) for lo, hi in zip(bmin, bmax))
+
+def crop(image, bbox, margin=0, copy=True):
     """Crop image using given bounding box.
 
     Args:
         img (ndarray): Input image.
         bbox (np.array, np.array): Input bounding box.
         margin (int): The size of margin.
+        copy (bool): Return a copy. If False, a view of the input image is returned (when the image is an ndarray).
     Returns:
         np.ndarray: Cropped image.
     """
-    bmin = bbox[0]
-    bmax = bbox[1]
-    bmin = np.maximum(0,bmin-margin)
-    bmax = np.minimum(np.array(image.shape),bmax+(margin+1))
-    dim = len(bmin)
-    slice_str = ','.join(['bmin[{0}]:bmax[{0}]'.format(i) for i in range(dim)])
-    return eval('image[{0}].copy()'.format(slice_str))
+    cropped = image[_crop_slices(image.shape, bbox, margin)]
+    return cropped.copy() if copy else cropped
 
 def trim(image, margin=0):
     """Trim image.
@@ -47,18 +73,143 @@ def trim(image, margin=0):
     bb = bbox(image)
     return crop(image, bb, margin)
 
-def uncrop(image,original_shape,bbox,margin=0,constant_values=0):
+def uncrop(image,original_shape,bbox,margin=0,constant_values=0,out=None):
     '''Revert cropping
 
     Args:
         image (ndarray): Input cropped image.
         bbox (np.array, np.array): Bounding box used for cropping.
         margin (int): Margin used for cropping.
-        constant_values (int or array_like): Passed to np.pad
+        constant_values (int or array_like): Value outside the bounding box. Passed to np.pad if array_like.
+        out (ndarray): Output array of original_shape. The image is written into it
+            and the outside is filled with constant_values. Allocated if None.
     Returns:
         np.ndarray: Uncropped image.
     '''
-    before = np.maximum(bbox[0]-margin,0)
-    after = np.maximum(np.array(original_shape)-bbox[1]-margin-1,0)
-    pad_width = np.array((before,after)).T
-    return np.pad(image,pad_width,'constant',constant_values=constant_values)
+    if not np.isscalar(constant_values):
+        before = np.maximum(bbox[0]-margin,0)
+        after = np.maximum(np.array(original_shape)-bbox[1]-margin-1,0)
+        pad_width = np.array((before,after)).T
+        padded = np.pad(image,pad_width,'constant',constant_values=constant_values)
+        if out is None:
+            return padded
+        out[...] = padded
+        return out
+    if out is None:
+        out = np.empty(original_shape, dtype=image.dtype)
+    elif tuple(out.shape) != tuple(original_shape):
+        raise ValueError('Shape of out {} does not match {}.'.format(out.shape, tuple(original_shape)))
+    slices = _crop_slices(original_shape, bbox, margin)
+    # fill only the outside of the bounding box
+    for d, s in enumerate(slices):
+        head = tuple(slices[:d]) + (slice(0, s.start),)
+        tail = tuple(slices[:d]) + (slice(s.stop, None),)
+        out[head] = constant_values
+        out[tail] = constant_values
+    out[slices] = image
+    return out
+
+def _iter_blocks(volume, n_slabs):
+    if hasattr(volume, 'iter_slabs'):
+        for block in volume.iter_slabs(n_slabs):
+            yield block
+    else:
+        for z in range(0, len(volume), n_slabs):
+            yield volume[z:z+n_slabs]
+
+def label_bboxes(volume, n_slabs=16):
+    """Compute bounding boxes of all labels in one pass.
+
+    The volume is read ``n_slabs`` slabs at a time, so memory-maps and
+    lazily loaded (e.g. chunk compressed) volumes are not loaded at once.
+
+    Args:
+        volume (ndarray or mhd.LazyVolume): Label image.
+        n_slabs (int): The number of slabs processed at once.
+    Returns:
+        dict: Bounding boxes (bbox_min, bbox_max) keyed by non-zero labels.
+    """
+    from scipy import ndimage
+    bmin = np.zeros((0, volume.ndim), dtype=np.int64)
+    bmax = np.zeros((0, volume.ndim), dtype=np.int64)
+    n_labels = 0
+    z = 0
+    for block in _iter_blocks(volume, n_slabs):
+        block = np.asarray(block)
+        objects = ndimage.find_objects(block.astype(np.intp, copy=False))
+        if len(objects) > len(bmin):
+            # grow geometrically, as labels numbered in raster order increase block by block
+            n = max(len(objects), 2 * len(bmin)) - len(bmin)
+            bmin = np.concatenate([bmin, np.full((n, volume.ndim), np.iinfo(np.int64).max)])
+            bmax = np.concatenate([bmax, np.full((n, volume.ndim), -1)])
+        n_labels = max(n_labels, len(objects))
+        present = np.flatnonzero(np.fromiter(map(operator.is_not, objects, itertools.repeat(None)), dtype=bool, count=len(objects)))
+        if len(present) > 0:
+            lo = np.array([[s.start for s in objects[i]] for i in present], dtype=np.int64)
+            hi = np.array([[s.stop for s in objects[i]] for i in present], dtype=np.int64) - 1
+            lo[:,0] += z
+            hi[:,0] += z
+            bmin[present] = np.minimum(bmin[present], lo)
+            bmax[present] = np.maximum(bmax[present], hi)
+        z += len(block)
+    labels = np.flatnonzero(bmax[:n_labels,0] >= 0)
+    return {int(i) + 1: (bmin[i], bmax[i]) for i in labels}
+
+def index_filename(filename):
+    """Filename of the bounding box index cached next to a volume."""
+    return os.path.splitext(filename)[0] + '.bbox.json'
+
+def _file_stamp(filename, volume):
+    return [[os.stat(f).st_mtime_ns, os.stat(f).st_size] for f in sorted(set([filename, volume.data_filename]))]
+
+def load_label_bboxes(filename, n_slabs=16):
+    """Load bounding boxes of all labels in a Meta Image.
+
+    The index is cached in ``index_filename(filename)`` and recomputed when
+    the image has been modified since.
+
+    Args:
+        filename (str): Label image filename (mhd or mha).
+        n_slabs (int): The number of slabs processed at once.
+    Returns:
+        dict: Bounding boxes (bbox_min, bbox_max) keyed by non-zero labels.
+    """
+    from ssrvtools import mhd
+    volume, _ = mhd.read_lazy(filename)
+    stamp = _file_stamp(filename, volume)
+    cache_filename = index_filename(filename)
+    if os.path.exists(cache_filename):
+        with open(cache_filename) as f:
+            cache = json.load(f)
+        if cache.get('stamp') == stamp:
+            return {int(label): (np.array(b[0]), np.array(b[1])) for label, b in cache['bboxes'].items()}
+    bboxes = label_bboxes(volume, n_slabs)
+    cache = {'stamp': stamp, 'bboxes': {str(label): [b[0].tolist(), b[1].tolist()] for label, b in bboxes.items()}}
+    with open(cache_filename, 'w') as f:
+        json.dump(cache, f)
+    return bboxes
+
+def crop_label(volume, label, margin=0, bboxes=None):
+    """Crop the bounding box of a label.
+
+    Only the slabs within the bounding box are read if ``volume`` is a filename.
+
+    Args:
+        volume (str or ndarray): Label image filename (mhd or mha) or label image.
+        label (int): Label.
+        margin (int): The size of margin.
+        bboxes (dict): Bounding boxes from ``label_bboxes``. Loaded from (or cached in) the index for a filename, and computed otherwise.
+    Returns:
+        (np.ndarray, (np.array, np.array)): Cropped image and the bounding box of the label.
+    """
+    if isinstance(volume, str):
+        from ssrvtools import mhd
+        if bboxes is None:
+            bboxes = load_label_bboxes(volume)
+        volume, _ = mhd.read_lazy(volume)
+    elif bboxes is None:
+        bboxes = label_bboxes(volume)
+    if label not in bboxes:
+        raise ValueError('Label {} is not in the image.'.format(label))
+    bbox = bboxes[label]
+    return crop(volume, bbox, margin), bbox
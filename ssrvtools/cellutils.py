@@ -1,16 +1,17 @@
 import argparse
 import sys, os
+import glob
+import time
 import re
 from PIL import Image
 import numpy as np
 import ssrvtools.boundingbox as bb
-import matplotlib.pyplot as plt
-from skimage.filters import threshold_local
+import ssrvtools.label_renderer as lr
 from scipy import ndimage
 import tqdm
-import scipy.spatial
-import mhd
+from ssrvtools import mhd
 import multiprocessing
+from ssrvtools.shared_array import SharedArray, bounded_imap
 
 class Searcher(object):
     def __init__(self, tree):
@@ -30,16 +31,8 @@ def _load_image(filename):
         pass
     return image
 
-def _label_cells(wall):
-    labels, n_labels = ndimage.label(wall==0)
-    count = np.bincount(labels.flatten())
-    count_image = count[labels]
-    labels[(count_image > (count_image.size/100)) & np.logical_not(wall)]  = 0 #bg
-    label_contour = (ndimage.binary_dilation(wall,structure=np.ones((3,3))) ^ wall)
-    min_area = 20
-    # label_contour[(count_image > (count_image.size/100))]  = 0 #bg
-    label_contour[count_image < min_area]  = 0
-
+def _fill_gaps_kdtree(labels, wall, label_contour):
+    import scipy.spatial
     cell_pts = np.array(np.where(label_contour)).T
     cell_tree = scipy.spatial.KDTree(cell_pts)
     wall_pts = np.array(np.where(wall)).T
@@ -52,20 +45,72 @@ def _label_cells(wall):
     for pts, ref_id in zip(wall_pts,ref_ids):
         ref_pts = cell_pts[ref_id]
         wall_label[pts[0],pts[1]] = labels[ref_pts[0],ref_pts[1]]
+    return wall_label
+
+def _fill_gaps_edt(labels, wall, label_contour):
+    # indices of the nearest contour pixel for every pixel
+    indices = ndimage.distance_transform_edt(np.logical_not(label_contour), return_distances=False, return_indices=True)
+    wall_label = np.zeros_like(labels)
+    wall = wall.astype(bool)
+    wall_label[wall] = labels[indices[0][wall], indices[1][wall]]
+    return wall_label
+
+_gap_fillers = {'edt':_fill_gaps_edt, 'kdtree':_fill_gaps_kdtree}
+
+def _label_cells(wall, gap_filling='edt'):
+    """Label cells and assign walls to the nearest cells.
 
+    Args:
+        wall (ndarray): Binary wall image.
+        gap_filling (str): 'edt' (Euclidean distance transform) or 'kdtree'.
+            Both assign each wall pixel the label of its nearest cell contour pixel
+            and differ only in ties between equidistant contour pixels.
+    Returns:
+        np.ndarray: Labels.
+    """
+    labels, n_labels = ndimage.label(wall==0)
+    count = np.bincount(labels.flatten())
+    count_image = count[labels]
+    labels[(count_image > (count_image.size/100)) & np.logical_not(wall)]  = 0 #bg
+    label_contour = (ndimage.binary_dilation(wall,structure=np.ones((3,3))) ^ wall)
+    min_area = 20
+    # label_contour[(count_image > (count_image.size/100))]  = 0 #bg
+    label_contour[count_image < min_area]  = 0
+    if not np.any(label_contour):
+        return labels
+
+    wall_label = _gap_fillers[gap_filling](labels, wall, label_contour)
     labels[wall_label>0] = wall_label[wall_label>0]
     return labels
 
-def _assign_labels(cells, ref_labels):
-    new_label = np.zeros_like(ref_labels[0])
-    for v in tqdm.trange(1,np.max(cells)+1,desc='Labeling'):
-        m = cells==v
-        count = np.bincount(ref_labels[m[None,:,:] & (ref_labels!=0)])
-        if (len(count)==0):
-            continue
-        l = np.argmax(count)
-        new_label[cells==v] = l
-    return new_label
+def _assign_labels(cells, ref_labels, weights=None):
+    """Assign each cell the most frequent non-zero reference label.
+
+    Args:
+        cells (ndarray): Cell labels.
+        ref_labels (ndarray): Stack of reference labels.
+        weights (list): Weight of each reference slice (default: all ones).
+            Slightly larger weights for nearer references break ties in their favour.
+    Returns:
+        np.ndarray: Labels.
+    """
+    n_cells = int(np.max(cells)) + 1
+    n_refs = int(np.max(ref_labels)) + 1
+    if weights is None:
+        table = np.zeros(n_cells*n_refs, dtype=np.int64)
+    else:
+        table = np.zeros(n_cells*n_refs, dtype=np.float64)
+    for i, ref in enumerate(ref_labels):
+        m = (cells!=0) & (ref!=0)
+        packed = cells[m].astype(np.int64)*n_refs + ref[m]
+        if weights is None:
+            table += np.bincount(packed, minlength=table.size)
+        else:
+            table += np.bincount(packed, minlength=table.size) * weights[i]
+    table = table.reshape((n_cells, n_refs))
+    lut = np.argmax(table, axis=1).astype(ref_labels.dtype)
+    lut[0] = 0
+    return lut[cells]
 
 def remove_small_area(binary, min_area=500):
     label_im, nb_labels = ndimage.label(binary)
@@ -76,6 +121,7 @@ def remove_small_area(binary, min_area=500):
     return label_im > 0
 
 def _local_thresh(gray, block_size, offset):
+    from skimage.filters import threshold_local
     local_thresh = threshold_local(gray, block_size, offset=offset, method='gaussian')
     wall = (gray < local_thresh)
     return wall
@@ -84,71 +130,510 @@ def dilate(image):
     from scipy import ndimage
     return ndimage.binary_dilation(image,structure=np.ones((3,3)))
 
-def color_cells(labels):
-    vals = np.linspace(0,255,np.max(labels)+1).astype(np.int32)
-    np.random.shuffle(vals)
-    cm = np.array([plt.cm.gist_ncar(e) for e in vals])
-    rgba = cm[labels]
-    rgba =  np.clip(np.round(rgba*255),0,255).astype(np.uint8)
-    rgba = rgba * (labels!=0)[:,:,None]
-    return rgba
+def color_cells(labels, seed=0):
+    return lr.render(labels, seed)
+
+def _extract_wall(image,block_size,offset,tile_size=None,processes=None):
+    """Extract cell wall.
 
-def _extract_wall(image,block_size,offset):
+    Args:
+        image (ndarray): Gray scale section image.
+        block_size (int): Block size for local threshold.
+        offset (int): Offset for local threshold.
+        tile_size (int): Process the image in tiles of this size in worker processes.
+            The result is the same as the untiled one. Untiled if None.
+        processes (int): Number of worker processes for tiles. Default: cpu count.
+    Returns:
+        np.ndarray: Binary wall image (uint8).
+    """
     original_shape = image.shape
     bbox = bb.bbox(image)
-    image = bb.crop(image,bbox,margin=1)
-    wall = remove_small_area(_local_thresh(image,block_size,offset))
-    from scipy.ndimage.morphology import binary_closing
-    wall = binary_closing(wall)
-    wall = bb.uncrop(wall, original_shape, bbox, margin=1).astype(np.uint8)
-    return wall
+    image = bb.crop(image,bbox,margin=1,copy=False)
+    if tile_size is None or all(s <= tile_size for s in image.shape):
+        wall = remove_small_area(_local_thresh(image,block_size,offset))
+        wall = ndimage.binary_closing(wall)
+    else:
+        wall = _extract_wall_tiled(image,block_size,offset,tile_size,processes)
+    return bb.uncrop(wall, original_shape, bbox, margin=1, out=np.empty(original_shape, dtype=np.uint8))
+
+def _tile_slices(shape, origin, tile_size, halo):
+    """Slices of a tile with halo and of the tile within it."""
+    outer = []
+    inner = []
+    for o, s in zip(origin, shape):
+        start = max(0, o - halo)
+        stop = min(s, o + tile_size + halo)
+        outer.append(slice(start, stop))
+        inner.append(slice(o - start, min(s, o + tile_size) - start))
+    return tuple(outer), tuple(inner)
+
+def _core_slices(shape, origin, tile_size):
+    return tuple(slice(o, min(s, o + tile_size)) for o, s in zip(origin, shape))
+
+class _TileThreshold(object):
+    """Threshold a tile and label its connected components."""
+    def __init__(self, image, wall, block_size, offset, tile_size):
+        self.image = image
+        self.wall = wall
+        self.block_size = block_size
+        self.offset = offset
+        self.tile_size = tile_size
+    def __call__(self, origin):
+        shape = self.image.shape
+        # the gaussian kernel of threshold_local is narrower than block_size
+        outer, inner = _tile_slices(shape, origin, self.tile_size, self.block_size)
+        core = _local_thresh(self.image.array[outer], self.block_size, self.offset)[inner]
+        self.wall.array[_core_slices(shape, origin, self.tile_size)] = core
+        labels, n_labels = ndimage.label(core)
+        areas = np.bincount(labels.ravel(), minlength=n_labels+1)[1:]
+        # labels are numbered in raster order, so the running max steps up at the first pixel of each label
+        indices = np.flatnonzero(labels)
+        running = np.maximum.accumulate(labels.ravel()[indices])
+        first = indices[np.concatenate([[True], running[1:] > running[:-1]])] if len(indices) else indices
+        y, x = np.divmod(first, core.shape[1])
+        first = (y + origin[0]) * shape[1] + (x + origin[1])
+        edges = labels[0], labels[-1], labels[:,0], labels[:,-1]
+        return n_labels, areas, first, edges
+
+class _TileFilter(object):
+    """Remove connected components of a tile which are not kept."""
+    def __init__(self, wall, tile_size):
+        self.wall = wall
+        self.tile_size = tile_size
+    def __call__(self, args):
+        origin, keep = args
+        core = _core_slices(self.wall.shape, origin, self.tile_size)
+        labels, _ = ndimage.label(self.wall.array[core])
+        self.wall.array[core] = np.concatenate([[False], keep])[labels]
+
+class _TileClosing(object):
+    """Close a tile."""
+    def __init__(self, wall, closed, tile_size):
+        self.wall = wall
+        self.closed = closed
+        self.tile_size = tile_size
+    def __call__(self, origin):
+        outer, inner = _tile_slices(self.wall.shape, origin, self.tile_size, 2)
+        self.closed.array[_core_slices(self.wall.shape, origin, self.tile_size)] = ndimage.binary_closing(self.wall.array[outer])[inner]
+
+def _keep_components(shape, tile_size, origins, results, min_area=500):
+    """Merge tile components across tile borders and decide which to keep as remove_small_area does."""
+    import scipy.sparse
+    import scipy.sparse.csgraph
+    n_labels = np.array([r[0] for r in results])
+    label_offsets = np.concatenate([[0], np.cumsum(n_labels)])
+    index = {origin: i for i, origin in enumerate(origins)}
+    pairs = []
+    for i, (y, x) in enumerate(origins):
+        for neighbor, edge, neighbor_edge in [((y, x + tile_size), 3, 2), ((y + tile_size, x), 1, 0)]:
+            if neighbor not in index:
+                continue
+            j = index[neighbor]
+            a = results[i][3][edge]
+            b = results[j][3][neighbor_edge]
+            m = (a > 0) & (b > 0)
+            pairs.append(np.stack([a[m] - 1 + label_offsets[i], b[m] - 1 + label_offsets[j]]))
+    pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2,0), dtype=np.int64)
+    n_nodes = label_offsets[-1]
+    graph = scipy.sparse.coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(n_nodes, n_nodes))
+    n_components, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    areas = np.bincount(components, weights=np.concatenate([r[1] for r in results]), minlength=n_components)
+    first = np.full(n_components, np.iinfo(np.int64).max)
+    np.minimum.at(first, components, np.concatenate([r[2] for r in results]))
+    keep = areas >= min_area
+    background = np.prod(shape) - areas.sum()
+    if n_components > 0 and areas.max() > background:
+        # the largest component in raster order, like argmax over the labels of the whole image
+        largest = np.flatnonzero(areas == areas.max())
+        keep[largest[np.argmin(first[largest])]] = False
+    keep = keep[components]
+    return [keep[label_offsets[i]:label_offsets[i+1]] for i in range(len(origins))]
+
+def _extract_wall_tiled(image,block_size,offset,tile_size,processes=None):
+    origins = [(y, x) for y in range(0, image.shape[0], tile_size) for x in range(0, image.shape[1], tile_size)]
+    with SharedArray(image.shape, image.dtype) as shared_image, \
+         SharedArray(image.shape, bool) as wall, SharedArray(image.shape, bool) as closed, \
+         multiprocessing.Pool(processes=processes or multiprocessing.cpu_count()) as pool:
+        shared_image.array[:] = image
+        results = pool.map(_TileThreshold(shared_image, wall, block_size, offset, tile_size), origins)
+        keep = _keep_components(image.shape, tile_size, origins, results)
+        pool.map(_TileFilter(wall, tile_size), zip(origins, keep))
+        pool.map(_TileClosing(wall, closed, tile_size), origins)
+        return closed.array.copy()
+
+class _SlabLabeler(object):
+    """Label connected regions of a slab and write them into the output memory-map."""
+    def __init__(self, output):
+        self.output = output
+    def __call__(self, args):
+        z, slab = args
+        from skimage import measure
+        labels, n_labels = measure.label(slab, background=0, connectivity=1, return_num=True)
+        out, _ = mhd.read_memmap(self.output, 'r+')
+        out[z:z+len(slab)] = labels
+        out.flush()
+        # only the boundary planes are sent back for merging
+        return n_labels, (labels[0].astype(np.uint32), slab[0]), (labels[-1].astype(np.uint32), slab[-1])
+
+class _SlabRelabeler(object):
+    """Map slab-local labels of the output memory-map to global labels."""
+    def __init__(self, output):
+        self.output = output
+    def __call__(self, args):
+        z, n_slabs, lut = args
+        out, _ = mhd.read_memmap(self.output, 'r+')
+        out[z:z+n_slabs] = lut[out[z:z+n_slabs]]
+        out.flush()
+
+def label_3d(input_filename, output_filename, slab_size=16, processes=None):
+    """Label 3D connected regions of a label volume slab by slab.
+
+    Face-adjacent voxels with the same non-zero value are connected.
+    Slabs are labelled independently in worker processes into an
+    uncompressed output, labels touching across slab boundaries are merged
+    and the output is relabelled in a second pass. Only a few slabs are held
+    in memory at once.
+
+    Args:
+        input_filename (str): Input label volume (mhd or mha).
+        output_filename (str): Output volume (mhd or mha) of uint32 labels numbered in raster order.
+        slab_size (int): The number of slices per slab.
+        processes (int): Number of worker processes. Default: cpu count.
+    Returns:
+        int: The number of connected regions.
+    """
+    import scipy.sparse
+    import scipy.sparse.csgraph
+    volume, header = mhd.read_lazy(input_filename)
+    mhd.create_memmap(output_filename, volume.shape, np.uint32, {key: header[key] for key in ['ElementSpacing','Offset','TransformMatrix','AnatomicalOrientation'] if key in header})
+    starts = list(range(0, len(volume), slab_size))
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes=processes) as pool:
+        slabs = zip(starts, volume.iter_slabs(slab_size))
+        label_offsets = [0]
+        pairs = []
+        previous = None # labels and values of the last plane of the previous slab
+        for n_labels, first, last in tqdm.tqdm(bounded_imap(pool, _SlabLabeler(output_filename), slabs, 2 * processes), total=len(starts), desc='Labeling slabs'):
+            if previous is not None:
+                (below_labels, below_values), (above_labels, above_values) = previous, first
+                m = (below_values != 0) & (below_values == above_values)
+                pair = np.stack([below_labels[m].astype(np.int64) - 1 + label_offsets[-2], above_labels[m].astype(np.int64) - 1 + label_offsets[-1]])
+                pairs.append(np.unique(pair.reshape((2,-1)), axis=1))
+            previous = last
+            label_offsets.append(label_offsets[-1] + n_labels)
+        label_offsets = np.array(label_offsets, dtype=np.int64)
+        pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2,0), dtype=np.int64)
+        n_nodes = label_offsets[-1]
+        graph = scipy.sparse.coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(n_nodes, n_nodes))
+        n_components, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+        components = components.astype(np.uint32) + 1
+
+        luts = ((z, min(slab_size, len(volume) - z), np.concatenate([[0], components[label_offsets[i]:label_offsets[i+1]]]).astype(np.uint32)) for i, z in enumerate(starts))
+        list(tqdm.tqdm(bounded_imap(pool, _SlabRelabeler(output_filename), luts, 2 * processes), total=len(starts), desc='Relabeling'))
+    return n_components
 
 _default_block_size = 21
 _default_offset = 1
-def extract_wall():
-    parser = argparse.ArgumentParser(description='Extract cell wall.')
-    parser.add_argument('input', help="Input image filename",metavar='<input>')
-    parser.add_argument('output', help="Output image filename",metavar='<output>')
+_default_tile_size = 4096
+def _save_wall(filename, wall):
+    if os.path.splitext(filename)[1] in ['.mhd','.mha']:
+        mhd.write(filename, wall.astype(np.uint8))
+    else:
+        cmap = np.array([[0,0,0,0],[255,0,0,255]]).astype(np.uint8)
+        Image.fromarray(cmap[wall]).save(filename)
+
+def _save_cells(filename, cells):
+    if os.path.splitext(filename)[1] in ['.mhd','.mha']:
+        mhd.write(filename,cells)
+    else:
+        rgba = color_cells(cells)
+        Image.fromarray(rgba).save(filename)
+
+class _SectionProcessor(object):
+    """Extract wall (and label cells) of a section and save the result."""
+    def __init__(self, label, block_size, offset, tile_size=None, processes=None, gap_filling='edt'):
+        self.label = label
+        self.block_size = block_size
+        self.offset = offset
+        self.tile_size = tile_size
+        self.processes = processes
+        self.gap_filling = gap_filling
+    def __call__(self, args):
+        input_filename, output_filename = args
+        start = time.time()
+        image = _load_image(input_filename)
+        wall = _extract_wall(image, self.block_size, self.offset, self.tile_size, self.processes)
+        if self.label:
+            _save_cells(output_filename, _label_cells(wall, self.gap_filling))
+        else:
+            _save_wall(output_filename, wall)
+        return input_filename, time.time() - start
+
+def _list_inputs(inputs, ext):
+    """Expand directories and glob patterns into filenames."""
+    filenames = []
+    for i in inputs:
+        if os.path.isdir(i):
+            filenames += sorted(glob.glob(os.path.join(i, '*'+ext)))
+        elif glob.has_magic(i):
+            filenames += sorted(glob.glob(i))
+        else:
+            filenames.append(i)
+    return filenames
+
+def _add_section_arguments(parser):
+    parser.add_argument('input', help="Input image filename(s), directories or glob patterns",metavar='<input>',nargs='+')
+    parser.add_argument('output', help="Output image filename, or output directory for multiple inputs",metavar='<output>')
     parser.add_argument('-b','--block_size', help="Block size for local threshold (default:{})".format(_default_block_size),default=_default_block_size,type=int,metavar='<size>')
     parser.add_argument('--offset', help="Offset for local threshold (default:{})".format(_default_offset),default=_default_offset,type=int,metavar='<n>')
+    parser.add_argument('--tile_size', help="Extract wall in tiles of this size in parallel for a single input (default:{}). 0 disables tiling".format(_default_tile_size),default=_default_tile_size,type=int,metavar='<size>')
+    parser.add_argument('--n_workers', help="Number of worker processes for sections, or for tiles of a single input (default: cpu count)",metavar='<n>',type=int)
+    parser.add_argument('--ext', help="File extension of input images in directories (default:%(default)s)",metavar='<extension>',default='.png')
+    parser.add_argument('--output_ext', help="File extension of output images for multiple inputs (default:%(default)s)",metavar='<extension>',default='.png')
+    parser.add_argument('--force', help="Overwrite outputs which are newer than their inputs",action='store_true')
 
-    args = parser.parse_args()
-    image = _load_image(args.input)
-    wall = _extract_wall(image, args.block_size, args.offset)
-    if os.path.splitext(args.output) in ['.mhd','.mha']:
-        mhd.write(args.output, wall.astype(np.uint8))
+def _process_sections(parser, args, label):
+    filenames = _list_inputs(args.input, args.ext)
+    if not filenames:
+        parser.error('No input images')
+    gap_filling = getattr(args, 'gap_filling', 'edt')
+    expanded = any([os.path.isdir(i) or glob.has_magic(i) for i in args.input])
+    batch = expanded or len(filenames) > 1 or os.path.isdir(args.output)
+    if not batch:
+        processor = _SectionProcessor(label, args.block_size, args.offset, args.tile_size or None, args.n_workers, gap_filling)
+        _, elapsed = processor((filenames[0], args.output))
+        print('{}: {:.2f} s'.format(filenames[0], elapsed))
+        return
+
+    os.makedirs(args.output, exist_ok=True)
+    tasks = [(f, os.path.join(args.output, os.path.splitext(os.path.basename(f))[0] + args.output_ext)) for f in filenames]
+    if len(set(o for _, o in tasks)) != len(tasks):
+        parser.error('Inputs from different directories have the same name')
+    todo = [(i, o) for i, o in tasks if args.force or not _is_up_to_date(o, [i])]
+    print('{} sections to process ({} up to date)'.format(len(todo), len(tasks)-len(todo)))
+    n_workers = args.n_workers or multiprocessing.cpu_count()
+    if gap_filling == 'kdtree':
+        # kdtree gap filling runs its own process pool
+        n_workers = 1
+    # sections are processed in parallel, so tiles of each section are not
+    processor = _SectionProcessor(label, args.block_size, args.offset, None, None, gap_filling)
+    start = time.time()
+    if n_workers == 1:
+        results = map(processor, todo)
+        for input_filename, elapsed in tqdm.tqdm(results, total=len(todo)):
+            tqdm.tqdm.write('{}: {:.2f} s'.format(input_filename, elapsed))
     else:
-        cmap = np.array([[0,0,0,0],[255,0,0,255]]).astype(np.uint8)
-        Image.fromarray(cmap[wall]).save(args.output)
+        with multiprocessing.Pool(processes=n_workers) as pool:
+            for input_filename, elapsed in tqdm.tqdm(pool.imap_unordered(processor, todo), total=len(todo)):
+                tqdm.tqdm.write('{}: {:.2f} s'.format(input_filename, elapsed))
+    print('Total: {:.2f} s'.format(time.time() - start))
+
+def extract_wall():
+    parser = argparse.ArgumentParser(description='Extract cell wall.')
+    _add_section_arguments(parser)
+
+    args = parser.parse_args()
+    _process_sections(parser, args, False)
 
 def label_cells():
     parser = argparse.ArgumentParser(description='Label cells.')
-    parser.add_argument('input', help="Input image filename",metavar='<input>')
-    parser.add_argument('output', help="Output image filename",metavar='<output>')
-    parser.add_argument('-b','--block_size', help="Block size for local threshold (default:{})".format(_default_block_size),default=_default_block_size,type=int,metavar='<size>')
-    parser.add_argument('--offset', help="Offset for local threshold (default:{})".format(_default_offset),default=_default_offset,type=int,metavar='<n>')
+    _add_section_arguments(parser)
+    parser.add_argument('--gap_filling', help="Method to assign walls to cells (default:%(default)s)",choices=list(_gap_fillers),default='edt')
 
     args = parser.parse_args()
-    image = _load_image(args.input)
-    wall = _extract_wall(image, args.block_size, args.offset)
-    cells = _label_cells(wall)
-    if os.path.splitext(args.output)[1] in ['.mhd','.mha']:
-        mhd.write(args.output,cells)
-    else:
-        rgba = color_cells(cells)
-        Image.fromarray(rgba).save(args.output)
+    _process_sections(parser, args, True)
+
+_chunk_pixels = 2**22
+
+def _pack_colors(pixels):
+    """Pack (N, channels) uint8 colors into uint32."""
+    if pixels.shape[-1] == 4 and pixels.flags['C_CONTIGUOUS']:
+        return pixels.view('<u4')[:,0]
+    packed = np.zeros(len(pixels), dtype=np.uint32)
+    for c in range(pixels.shape[-1]):
+        packed |= pixels[:,c].astype(np.uint32) << (8*c)
+    return packed
+
+def _iter_pixel_chunks(image):
+    pixels = image.reshape((-1,image.shape[-1]))
+    for start in range(0, len(pixels), _chunk_pixels):
+        yield start, pixels[start:start+_chunk_pixels]
+
+def _find_palette(images):
+    """Find all colors in images.
+
+    Args:
+        images (iterable): Images of shape (..., channels).
+    Returns:
+        np.ndarray: Colors sorted by alpha (last channel) and then by channels. The index of a color is its label.
+    """
+    packed = np.zeros(0, dtype=np.uint32)
+    n_channels = None
+    for image in images:
+        n_channels = image.shape[-1]
+        for _, chunk in _iter_pixel_chunks(image):
+            packed = np.union1d(packed, np.unique(_pack_colors(chunk)))
+    return _palette(packed, n_channels)
+
+def _palette(packed, n_channels):
+    """Unpack unique packed colors sorted as in _find_palette."""
+    colors = ((packed[:,None] >> (8*np.arange(n_channels, dtype=np.uint32))) & 0xff).astype(np.uint8)
+    keys = [colors[:,c] for c in reversed(range(n_channels))] + [colors[:,-1]]
+    return colors[np.lexsort(keys)]
+
+def _label_dtype(colors):
+    return np.uint8 if len(colors) <= 256 else np.uint16
+
+def _sorted_palette(colors):
+    """Packed colors sorted for binary search and their labels."""
+    packed = _pack_colors(colors)
+    order = np.argsort(packed)
+    return packed[order], order
+
+def _lookup_labels(sorted_packed, labels, packed, n_channels=4):
+    """Labels of packed colors.
+
+    Raises:
+        ValueError: If a color is not in the palette.
+    """
+    indices = np.minimum(np.searchsorted(sorted_packed, packed), len(sorted_packed) - 1)
+    unmatched = sorted_packed[indices] != packed
+    if unmatched.any():
+        color = [int(packed[unmatched][0]) >> (8*c) & 0xff for c in range(n_channels)]
+        raise ValueError('Color {} is not in the colors.'.format(color))
+    return labels[indices]
+
+def _rgba2label_into(rgba, colors, out):
+    sorted_packed, order = _sorted_palette(colors)
+    labels = order.astype(out.dtype)
+    out = out.reshape(-1)
+    for start, chunk in _iter_pixel_chunks(rgba):
+        out[start:start+len(chunk)] = _lookup_labels(sorted_packed, labels, _pack_colors(chunk), chunk.shape[-1])
 
 def rgba2label(rgba):
-    unique_colors = np.unique(rgba[:,::8,::8].reshape((-1,rgba.shape[-1])),axis=0)
-    unique_colors = np.array(sorted(unique_colors,key=lambda x:x[-1]))
-    reshaped = rgba.reshape((-1,rgba.shape[-1]))
-    converted = np.zeros(len(reshaped),dtype=np.uint8)
-    for i in range(1,len(unique_colors)):
-        c = unique_colors[i]
-        m = reshaped == c[None,:]
-        m = np.all(m, axis=-1)
-        converted[m] = i
-    return converted.reshape(rgba.shape[:-1]), unique_colors
+    """Convert color image(s) into labels.
+
+    Args:
+        rgba (ndarray): Color image(s) of shape (..., channels).
+    Returns:
+        tuple: Labels and colors (colormap). Label 0 is the first color, usually transparent black.
+    """
+    rgba = np.ascontiguousarray(rgba)
+    colors = _find_palette([rgba])
+    labels = np.empty(rgba.shape[:-1], dtype=_label_dtype(colors))
+    _rgba2label_into(rgba, colors, labels)
+    return labels, colors
+
+def rgba2label_files(filenames, out=None, colors=None):
+    """Convert color images into a label stack one image at a time.
+
+    Every image is decoded once. Without ``colors``, each chunk of pixels
+    is labelled by its own colors while all colors are collected, and the
+    stack is relabelled by the whole palette at the end. This second pass
+    reads only the label stack, which is much cheaper than decoding the
+    images again, and only a single color image is held in memory.
+
+    Args:
+        filenames (list): Image filenames.
+        out (ndarray): Output stack, e.g. a memory-map from mhd.create_memmap. Allocated if None.
+        colors (ndarray): Colors found by a previous call. Searched in the images if None.
+    Returns:
+        tuple: Labels and colors as in rgba2label.
+    Raises:
+        ValueError: If ``colors`` is given and an image has a color not in it, or ``out`` cannot hold the labels.
+    """
+    if out is None:
+        width, height = Image.open(filenames[0]).size
+        out = np.empty((len(filenames), height, width), dtype=_label_dtype(colors if colors is not None else [0]))
+        is_allocated = True
+    else:
+        is_allocated = False
+    max_label = np.iinfo(out.dtype).max
+    if colors is not None:
+        if max_label < len(colors) - 1:
+            raise ValueError('{} colors do not fit into {}'.format(len(colors), out.dtype))
+        for i, filename in enumerate(filenames):
+            _rgba2label_into(np.ascontiguousarray(np.array(Image.open(filename))), colors, out[i])
+        return out, colors
+
+    chunk_colors = [] # (image index, start, packed colors of the chunk)
+    for i, filename in enumerate(filenames):
+        rgba = np.ascontiguousarray(np.array(Image.open(filename)))
+        n_channels = rgba.shape[-1]
+        labels = out[i].reshape(-1)
+        for start, chunk in _iter_pixel_chunks(rgba):
+            packed, local = np.unique(_pack_colors(chunk), return_inverse=True)
+            if len(packed) - 1 > max_label:
+                if not is_allocated:
+                    raise ValueError('{} colors do not fit into {}'.format(len(packed), out.dtype))
+                out = out.astype(np.uint16) # more colors than expected
+                max_label = np.iinfo(out.dtype).max
+                labels = out[i].reshape(-1)
+            labels[start:start+len(chunk)] = local.reshape(-1)
+            chunk_colors.append((i, start, packed))
+    colors = _palette(np.unique(np.concatenate([c for _, _, c in chunk_colors])), n_channels)
+    if max_label < len(colors) - 1:
+        if not is_allocated:
+            raise ValueError('{} colors do not fit into {}'.format(len(colors), out.dtype))
+        out = out.astype(_label_dtype(colors))
+    sorted_packed, order = _sorted_palette(colors)
+    for i, start, packed in chunk_colors:
+        labels = out[i].reshape(-1)
+        lut = _lookup_labels(sorted_packed, order.astype(out.dtype), packed)
+        labels[start:start+_chunk_pixels] = lut[labels[start:start+_chunk_pixels]]
+    return out, colors
+
+def _section_number(filename):
+    matches = re.findall(r'\d+',os.path.basename(filename))
+    if matches:
+        return int(matches[-1])
+    return None
+
+def _output_basename(input_filename):
+    matches = re.findall(r'\d+',os.path.basename(input_filename))
+    if matches:
+        return matches[-1]+'.png'
+    return os.path.basename(input_filename)
+
+def _nearest_references(section, ref_sections):
+    """Indices of the nearest references below and above ``section`` with tie-break weights."""
+    below = [i for i, r in enumerate(ref_sections) if r < section]
+    above = [i for i, r in enumerate(ref_sections) if r > section]
+    ids = []
+    if below:
+        ids.append(max(below, key=lambda i: ref_sections[i]))
+    if above:
+        ids.append(min(above, key=lambda i: ref_sections[i]))
+    distances = [abs(ref_sections[i]-section) for i in ids]
+    return ids, [d == min(distances) for d in distances]
+
+def _is_up_to_date(output_filename, input_filenames):
+    if not os.path.exists(output_filename):
+        return False
+    return os.path.getmtime(output_filename) > max(os.path.getmtime(f) for f in input_filenames)
+
+class _Assigner(object):
+    """Label cells in a section and assign them labels from shared reference labels."""
+    def __init__(self, refs, cmap, block_size, offset, gap_filling):
+        self.refs = refs
+        self.cmap = cmap
+        self.block_size = block_size
+        self.offset = offset
+        self.gap_filling = gap_filling
+    def __call__(self, args):
+        input_filename, output_filename, ref_ids, nearest = args
+        image = _load_image(input_filename)
+        wall = _extract_wall(image, self.block_size, self.offset)
+        cells = _label_cells(wall, self.gap_filling)
+        weights = None
+        if not all(nearest):
+            # small enough not to outweigh a difference of one pixel
+            eps = 1.0 / (2 * cells.size)
+            weights = [1 + eps if n else 1 for n in nearest]
+        new_labels = _assign_labels(cells, self.refs.array[ref_ids], weights)
+        Image.fromarray(self.cmap[new_labels]).save(output_filename)
+        return output_filename
 
 def assign_labels():
     parser = argparse.ArgumentParser(description='Assign labels.')
@@ -157,25 +642,73 @@ def assign_labels():
     parser.add_argument('-o','--output', help="Output directory (default:.)",metavar='<dirname>',default='.')
     parser.add_argument('-b','--block_size', help="Block size for local threshold (default:{})".format(_default_block_size),default=_default_block_size,type=int,metavar='<size>')
     parser.add_argument('--offset', help="Offset for local threshold (default:{})".format(_default_offset),default=_default_offset,type=int,metavar='<n>')
+    parser.add_argument('--gap_filling', help="Method to assign walls to cells (default:%(default)s)",choices=list(_gap_fillers),default='edt')
+    parser.add_argument('--stack', help="Use only the nearest references below and above each input section. Section numbers are taken from the last number in the filenames and inputs with a reference are skipped",action='store_true')
+    parser.add_argument('--n_workers', help="Number of worker processes (default: cpu count, 1 with kdtree gap filling)",metavar='<n>',type=int)
+    parser.add_argument('--force', help="Overwrite outputs which are newer than their inputs",action='store_true')
 
     args = parser.parse_args()
-    refs = np.stack([np.array(Image.open(filename)) for filename in args.reference])
-    refs, cmap = rgba2label(refs)
-    for input_filename in args.input:
-        matches = re.findall('\d+',os.path.basename(input_filename))
-        if matches:
-            output_filename = matches[-1]+'.png'
+    n_workers = args.n_workers or multiprocessing.cpu_count()
+    if args.gap_filling == 'kdtree':
+        # kdtree gap filling runs its own process pool
+        if args.n_workers not in (None, 1):
+            parser.error('--gap_filling kdtree cannot be used with --n_workers')
+        n_workers = 1
+
+    tasks = []
+    if args.stack:
+        ref_sections = [_section_number(filename) for filename in args.reference]
+        if None in ref_sections:
+            parser.error('No section number in reference filename "{}"'.format(args.reference[ref_sections.index(None)]))
+        for input_filename in args.input:
+            section = _section_number(input_filename)
+            if section is None:
+                parser.error('No section number in input filename "{}"'.format(input_filename))
+            if section in ref_sections:
+                continue
+            ref_ids, nearest = _nearest_references(section, ref_sections)
+            tasks.append((input_filename, ref_ids, nearest))
+    else:
+        ref_ids = list(range(len(args.reference)))
+        tasks = [(input_filename, ref_ids, [True]*len(ref_ids)) for input_filename in args.input]
+
+    todo = []
+    for input_filename, ref_ids, nearest in tasks:
+        output_filename = os.path.join(args.output,_output_basename(input_filename))
+        if not args.force and _is_up_to_date(output_filename, [input_filename] + [args.reference[i] for i in ref_ids]):
+            continue
+        todo.append((input_filename, output_filename, ref_ids, nearest))
+    print('{} sections to label ({} up to date)'.format(len(todo), len(tasks)-len(todo)))
+    if not todo:
+        return 0
+
+    used = [args.reference[i] for i in sorted(set(i for task in todo for i in task[2]))]
+    remap = {args.reference.index(filename): j for j, filename in enumerate(used)}
+    todo = [(i, o, [remap[r] for r in ref_ids], nearest) for i, o, ref_ids, nearest in todo]
+    refs, cmap = rgba2label_files(used)
+    with SharedArray(refs.shape, refs.dtype) as shared_refs:
+        shared_refs.array[:] = refs
+        del refs
+        assigner = _Assigner(shared_refs, cmap, args.block_size, args.offset, args.gap_filling)
+        if n_workers == 1:
+            list(tqdm.tqdm(map(assigner, todo), total=len(todo), desc='Assigning'))
         else:
-            output_filename = os.path.basename(input_filename)
-        image = _load_image(input_filename)
-        wall = _extract_wall(image, args.block_size, args.offset)
-        cells = _label_cells(wall)
-        new_labels = _assign_labels(cells,refs)
-        rgba = cmap[new_labels]
-        Image.fromarray(rgba).save(os.path.join(args.output,output_filename))
+            with multiprocessing.Pool(processes=n_workers) as pool:
+                list(tqdm.tqdm(pool.imap_unordered(assigner, todo), total=len(todo), desc='Assigning'))
+
+def label_volume():
+    parser = argparse.ArgumentParser(description='Label 3D connected regions of a label volume.')
+    parser.add_argument('input', help="Input label volume (mhd or mha)",metavar='<input>')
+    parser.add_argument('output', help="Output label volume (mhd or mha)",metavar='<output>')
+    parser.add_argument('--slab_size', help="The number of slices labelled at once (default:%(default)s)",default=16,type=int,metavar='<n>')
+    parser.add_argument('--n_workers', help="Number of worker processes (default: cpu count)",metavar='<n>',type=int)
+
+    args = parser.parse_args()
+    n = label_3d(args.input, args.output, args.slab_size, args.n_workers)
+    print('{} regions'.format(n))
 
 def main():
-    commands = ['extract_wall','label_cells','assign_labels']
+    commands = ['extract_wall','label_cells','assign_labels','label_volume']
     if len(sys.argv) <= 1 or sys.argv[1] in ['-h','--help']:
         print('Usage:'+sys.argv[0]+' <command> <args> ...')
         print('Commands:',commands)
@@ -0,0 +1,69 @@
+"""Command line interface of ssrvtools.
+
+``ssrvtools <command> <args> ...`` runs a command. Modules of commands are
+imported only when the command is run, so that a command does not pay for
+the dependencies of the others.
+"""
+import sys
+import importlib
+
+commands = [
+    ('img2mhd', 'image_converter:img2mhd'),
+    ('label2mhd', 'image_converter:label2mhd'),
+    ('mhd2polygon', 'polygon_converter:main'),
+    ('extract_wall', 'cellutils:extract_wall'),
+    ('label_cells', 'cellutils:label_cells'),
+    ('assign_labels', 'cellutils:assign_labels'),
+    ('label_volume', 'cellutils:label_volume'),
+    ('median_filter', 'image_filter:median_filter'),
+    ('label2png', 'label_renderer:main'),
+]
+
+registration_commands = [
+    ('coarse_rigid_registration_init', 'coarse_rigid_registration:main'),
+    ('fine_rigid_registration_init', 'fine_rigid_registration:main'),
+    ('coarse_rigid_registration', 'rigid_registration:coarse_registration'),
+    ('fine_rigid_registration', 'rigid_registration:fine_registration'),
+    ('apply_rigid_transformations', 'apply_transformation:main'),
+    ('apply_rigid_transformation', 'apply_transformation:apply_rigid_transformation'),
+    ('apply_inverse_rigid_transformation', 'apply_transformation:apply_inverse_rigid_transformation'),
+    ('nonrigid_registration', 'nonrigid_registration:main'),
+    ('init_workspace', 'init_workspace:main'),
+    ('finalize_registration', 'finalize_registration:main'),
+    ('compose_images', 'compose_images:main'),
+    ('manual_rigid_registration', 'manual_rigid_registration:main')
+]
+
+commands = commands + [(name,'registration.'+func) for name, func in registration_commands]
+
+def load(command):
+    """Import the module of a command and return its function.
+
+    Args:
+        command (str): Command name.
+    Returns:
+        callable: Function which parses ``sys.argv`` and runs the command.
+    """
+    module, func = dict(commands)[command].split(':')
+    return getattr(importlib.import_module('ssrvtools.'+module), func)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    names = [name for name, _ in commands]
+    if len(argv) == 0 or argv[0] in ['-h','--help']:
+        print('Usage: ssrvtools <command> <args> ...')
+        print('Commands:')
+        for name in names:
+            print('  '+name)
+        return 1 if len(argv) == 0 else 0 # no command is an error, asking for help is not
+    if argv[0] not in names:
+        print('Error: unknown command "{}"'.format(argv[0]))
+        print('Commands:',names)
+        return 1
+
+    command = argv[0]
+    sys.argv = ['ssrvtools '+command] + argv[1:]
+    return load(command)()
+
+if __name__ == "__main__":
+    sys.exit(main())
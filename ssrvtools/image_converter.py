@@ -6,41 +6,386 @@ import multiprocessing
 import tqdm
 from PIL import Image
 import numpy as np
-import ssrvtools.mhd
-from sklearn.neighbors import KDTree
+import hashlib
+import json
+from ssrvtools import mhd
+from ssrvtools.shared_array import SharedArray, bounded_imap
 
 def multiply_alpha(image):
     a = image[:,:,3] / 255.0
     return (image[:,:,:3] * np.expand_dims(a, -1)).astype(np.uint8)
 
+def open_reduced(filename, stride, downsample='point'):
+    """Open an image downsampled by ``stride``.
+
+    ``'point'`` sampling picks every ``stride``-th pixel like
+    ``image[::stride, ::stride]`` without converting the full resolution
+    image into an array. ``'area'`` averaging lets the JPEG decoder scale
+    the image down by a power of 2 (draft mode) and averages the remaining
+    factor with ``Image.reduce``.
+
+    Args:
+        filename (str): Image filename.
+        stride (int): Downsampling factor.
+        downsample (str): 'point' or 'area'.
+    Returns:
+        PIL.Image.Image: Downsampled image.
+    """
+    image = Image.open(filename)
+    if stride == 1:
+        return image
+    w, h = image.size
+    if downsample == 'area':
+        scale = min(stride & -stride, 8) # largest power of 2 dividing stride, within JPEG's scaling range
+        if scale > 1 and image.format == 'JPEG':
+            image.draft(image.mode, (-(-w // scale), -(-h // scale)))
+            scale = -(-w // image.size[0])
+        else:
+            scale = 1
+        return image.reduce(stride // scale) if stride > scale else image
+    if downsample != 'point':
+        raise ValueError('Unknown downsampling method: ' + downsample)
+    size = (-(-w // stride), -(-h // stride))
+    offset = 0.5 - stride / 2 # sample the top-left pixel of each stride x stride block
+    return image.transform(size, Image.AFFINE, (stride, 0, offset, 0, stride, offset), Image.NEAREST)
+
 class Loader(object):
-    def __init__(self, stride):
+    def __init__(self, stride, downsample='point'):
         self.stride = stride
+        self.downsample = downsample
     def __call__(self, filename):
-        img = np.array(Image.open(filename))[::self.stride,::self.stride]
+        try:
+            img = np.array(open_reduced(filename, self.stride, self.downsample))
+        except ValueError: # image mode not supported by PIL's transform/reduce
+            if self.downsample != 'point':
+                raise
+            img = np.array(Image.open(filename))[::self.stride,::self.stride]
         if img.ndim == 3 and img.shape[-1] > 3:
             return multiply_alpha(img)
         else:
             return img
 
-def load_images(filenames,stride=1):
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        images = list(tqdm.tqdm(pool.imap(Loader(stride), filenames), total=len(filenames), desc='Loading images'))
-        return np.stack(images)
+class _LoadToSharedArray(object):
+    """Load an image into a slice of a shared array. Only indices cross process boundaries."""
+    def __init__(self, loader, volume):
+        self.loader = loader
+        self.volume = volume
+    def __call__(self, args):
+        z, filename = args
+        self.volume.array[z] = self.loader(filename)
+
+def load_images(filenames,stride=1,downsample='point',processes=None):
+    loader = Loader(stride,downsample)
+    first = loader(filenames[0])
+    with SharedArray((len(filenames),) + first.shape, first.dtype) as volume:
+        volume.array[0] = first
+        with multiprocessing.Pool(processes=processes or multiprocessing.cpu_count()) as pool:
+            tasks = list(enumerate(filenames))[1:]
+            list(tqdm.tqdm(pool.imap(_LoadToSharedArray(loader, volume), tasks), initial=1, total=len(filenames), desc='Loading images'))
+        return volume.array.copy()
+
+def pack_rgb(rgb):
+    """Pack RGB values into uint32 (0x00RRGGBB)."""
+    rgb = np.asarray(rgb).astype(np.uint32)
+    return (rgb[...,0] << 16) | (rgb[...,1] << 8) | rgb[...,2]
 
 class LabelConberter(object):
+    """Convert colors into indices of the nearest colormap entries.
+
+    Colors which exactly match an entry are found by a binary search of
+    the packed RGB values in the sorted packed colormap in one vectorized
+    pass. Only the remaining colors (e.g. antialiasing or JPEG noise) are
+    searched by the KDTree.
+    """
     def __init__(self, cmap):
-        self.tree = KDTree(cmap)
+        self.cmap = np.asarray(cmap)
+        self._tree = None
+        self._exact = None
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tree'] = None # rebuilt in the worker instead of pickled
+        return state
+    @property
+    def tree(self):
+        if self._tree is None:
+            from sklearn.neighbors import KDTree # slow to import and only needed for unmatched colors
+            self._tree = KDTree(self.cmap)
+        return self._tree
+    @property
+    def exact(self):
+        """Sorted packed colors of the entries with integer RGB values and their indices."""
+        if self._exact is None:
+            exact = np.all((self.cmap == np.round(self.cmap)) & (self.cmap >= 0) & (self.cmap <= 255), axis=-1)
+            indices = np.where(exact)[0]
+            colors, first = np.unique(pack_rgb(self.cmap[indices]), return_index=True) # the first entry wins for duplicates
+            self._exact = colors, indices[first].astype(np.int32)
+        return self._exact
+    def convert(self, image):
+        """Convert colors into labels.
+
+        Returns:
+            (np.ndarray, int): Flattened labels and the number of pixels converted by the nearest color search.
+        """
+        packed = pack_rgb(np.reshape(image,(-1,3)))
+        colors, indices = self.exact
+        if len(colors) > 0:
+            pos = np.minimum(np.searchsorted(colors, packed), len(colors) - 1)
+            converted = np.where(colors[pos] == packed, indices[pos], -1).astype(np.int32)
+        else:
+            converted = np.full(len(packed), -1, dtype=np.int32)
+        unmatched = converted < 0
+        n_fallback = int(np.count_nonzero(unmatched))
+        if n_fallback > 0:
+            colors, inverse = np.unique(packed[unmatched], return_inverse=True)
+            rgb_points = np.stack([(colors >> 16) & 255, (colors >> 8) & 255, colors & 255], axis=-1)
+            _, nearest = self.tree.query(rgb_points)
+            converted[unmatched] = nearest[inverse.reshape(-1), 0]
+        return converted, n_fallback
     def __call__(self, image):
-        rgb_points = np.reshape(image,(-1,3))
-        _, converted = self.tree.query(rgb_points)
-        return converted
+        return self.convert(image)[0]
+
+class _LabelSharedArray(object):
+    """Convert a slice of a shared array into labels in another shared array."""
+    def __init__(self, converter, image, label):
+        self.converter = converter
+        self.image = image
+        self.label = label
+    def __call__(self, z):
+        self.label.array[z] = np.reshape(self.converter(self.image.array[z]), self.label.shape[1:])
+
+def to_label(image, cmap, processes=None):
+    with SharedArray(image.shape, image.dtype) as shared_image, SharedArray(image.shape[:-1], np.uint8) as label:
+        shared_image.array[:] = image
+        with multiprocessing.Pool(processes=processes or multiprocessing.cpu_count()) as pool:
+            list(tqdm.tqdm(pool.imap(_LabelSharedArray(LabelConberter(cmap), shared_image, label), range(len(image))), total=len(image), desc='Converting'))
+        return label.array.copy()
+
+class SliceConverter(object):
+    """Load an image and convert it into a slice of the output volume.
+
+    Returns the slice and the number of pixels converted by the nearest color search.
+    """
+    def __init__(self, stride, channel=None, cmap=None, downsample='point'):
+        self.loader = Loader(stride, downsample)
+        self.channel = channel
+        self.label_converter = None if cmap is None else LabelConberter(cmap)
+    def __call__(self, filename):
+        image = self.loader(filename)
+        if self.channel is not None:
+            image = image[:,:,self.channel]
+        n_fallback = 0
+        if self.label_converter is not None:
+            converted, n_fallback = self.label_converter.convert(image)
+            image = np.reshape(converted.astype(np.uint8), image.shape[:-1])
+        return image, n_fallback
+
+class _SliceToMemmap(object):
+    """Convert an image and write it into the output memory-map directly."""
+    def __init__(self, converter, output):
+        self.converter = converter
+        self.output = output
+    def __call__(self, args):
+        z, filename = args
+        image, n_fallback = self.converter(filename)
+        volume, _ = mhd.read_memmap(self.output, mode='r+')
+        volume[z] = image
+        volume.flush()
+        return n_fallback
+
+class _SliceToSharedArray(object):
+    """Convert an image into a slot of a shared ring buffer."""
+    def __init__(self, converter, slots):
+        self.converter = converter
+        self.slots = slots
+    def __call__(self, args):
+        z, filename = args
+        image, n_fallback = self.converter(filename)
+        self.slots.array[z % len(self.slots.array)] = image
+        return n_fallback
+
+def convert_images(filenames, output, converter, header={}, chunk_slabs=None, processes=None):
+    """Convert images into one mhd image slice by slice.
+
+    Workers write converted slices straight into their destination and
+    only indices and counts are returned to the parent. Uncompressed output
+    is filled through a memory-map of the output file. Compressed output
+    goes through a ring of shared memory slots which the parent compresses
+    in order. Memory usage depends on the number of slices in flight rather
+    than the number of images.
 
-def to_label(image, cmap):
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        converted_images = list(tqdm.tqdm(pool.imap(LabelConberter(cmap), image), total=len(image), desc='Converting'))
-    converted = np.stack(converted_images)
-    return np.reshape(converted.astype(np.uint8), image.shape[:-1])
+    Args:
+        filenames (list): Input image filenames in slice order.
+        output (str): Output mhd filename.
+        converter (SliceConverter): Slice converter.
+        header (dict): Meta data for the output image. Data is written uncompressed unless CompressedData is True.
+        chunk_slabs (int): Number of slices per compressed chunk. See ``mhd.write``.
+        processes (int): Number of worker processes. Default: cpu count.
+    Returns:
+        int: The number of pixels converted by the nearest color search.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    first, n_fallback = converter(filenames[0])
+    header = dict(header)
+    if first.ndim == 3 and first.shape[-1] == 3:
+        header['ElementNumberOfChannels'] = first.shape[-1]
+    shape = (len(filenames),) + first.shape
+    tasks = list(enumerate(filenames))[1:]
+    n_slots = 2 * processes
+    if str(header.get('CompressedData', False)) != 'True':
+        volume = mhd.create_memmap(output, shape, first.dtype, header)
+        volume[0] = first
+        del volume
+        with multiprocessing.Pool(processes=processes) as pool:
+            for n in tqdm.tqdm(bounded_imap(pool, _SliceToMemmap(converter, output), tasks, n_slots), initial=1, total=len(filenames), desc='Converting'):
+                n_fallback += n
+        return n_fallback
+    # the shared memory is created before the workers, so that they share the parent's resource tracker
+    with SharedArray((n_slots,) + first.shape, first.dtype) as slots, \
+         multiprocessing.Pool(processes=processes) as pool, \
+         mhd.Writer(output, shape, first.dtype, header, chunk_slabs) as writer:
+        writer.write(first[None])
+        # a slot is reused only after the parent has consumed it, because at most n_slots tasks are in flight
+        for z, n in enumerate(tqdm.tqdm(bounded_imap(pool, _SliceToSharedArray(converter, slots), tasks, n_slots), initial=1, total=len(filenames), desc='Converting'), 1):
+            writer.write(slots.array[z % n_slots][None])
+            n_fallback += n
+    return n_fallback
+
+def _manifest_filename(output):
+    return os.path.splitext(output)[0] + '.manifest.json'
+
+def _file_digest(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def _section_entry(filename, digest=None):
+    stat = os.stat(filename)
+    return {'filename': os.path.abspath(filename), 'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+            'sha1': digest if digest is not None else _file_digest(filename)}
+
+def _current_digest(entry):
+    """Hash of a section in a manifest entry. The file is hashed only when mtime or size differs."""
+    stat = os.stat(entry['filename'])
+    if stat.st_mtime_ns == entry['mtime'] and stat.st_size == entry['size']:
+        return entry['sha1']
+    return _file_digest(entry['filename'])
+
+def _write_manifest(output, filenames, settings, digests={}, processes=None):
+    """Write the manifest. Only sections whose digest is not given are hashed."""
+    todo = [f for f in filenames if f not in digests]
+    if todo:
+        with multiprocessing.Pool(processes=min(len(todo), processes or multiprocessing.cpu_count())) as pool:
+            digests = dict(digests)
+            digests.update(zip(todo, pool.map(_file_digest, todo)))
+    manifest = {'settings': settings, 'sections': [_section_entry(f, digests[f]) for f in filenames]}
+    with open(_manifest_filename(output), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+def _plan_update(filenames, output, settings):
+    """Find sections to be re-converted and appended.
+
+    Returns:
+        (list, list, dict) or None: z indices of modified sections and of
+        new sections, and the current digests of the existing sections by
+        filename, or None if the output has to be rebuilt.
+    """
+    manifest_filename = _manifest_filename(output)
+    if not (os.path.exists(output) and os.path.exists(manifest_filename)):
+        return None
+    with open(manifest_filename) as f:
+        manifest = json.load(f)
+    if manifest['settings'] != settings:
+        return None
+    sections = manifest['sections']
+    if [e['filename'] for e in sections] != [os.path.abspath(f) for f in filenames[:len(sections)]]:
+        return None # removed or inserted sections shift z indices
+    try:
+        digests = [_current_digest(e) for e in sections]
+    except OSError:
+        return None
+    modified = [z for z, (e, d) in enumerate(zip(sections, digests)) if d != e['sha1']]
+    return modified, list(range(len(sections), len(filenames))), dict(zip(filenames, digests))
+
+def update_images(filenames, output, converter, header={}, chunk_slabs=None, settings={}, processes=None):
+    """Convert images into one mhd image, re-converting only modified sections.
+
+    A manifest (``<output>.manifest.json``) records mtime, size, hash and z
+    index of each section. When the output and the manifest are consistent
+    with the inputs, modified sections are re-converted and patched into
+    the output (in place for uncompressed or chunked data) and new sections
+    are appended. Otherwise the output is rebuilt by ``convert_images``.
+
+    Args:
+        filenames (list): Input image filenames in slice order.
+        output (str): Output mhd filename.
+        converter (SliceConverter): Slice converter.
+        header (dict): Meta data for the output image.
+        chunk_slabs (int): Number of slices per compressed chunk. See ``mhd.write``.
+        settings (dict): Conversion settings. The output is rebuilt when they change.
+        processes (int): Number of worker processes. Default: cpu count.
+    Returns:
+        int: The number of pixels converted by the nearest color search.
+    """
+    settings = dict(settings, header=header, chunk_slabs=chunk_slabs)
+    plan = _plan_update(filenames, output, settings)
+    volume = None
+    if plan is not None:
+        modified, appended, digests = plan
+        volume = mhd.read_lazy(output)[0]
+        if len(modified) > len(volume) // 2:
+            plan = None # rebuilding is cheaper
+    if plan is None:
+        n_fallback = convert_images(filenames, output, converter, header, chunk_slabs, processes)
+        _write_manifest(output, filenames, settings, processes=processes)
+        return n_fallback
+    n_fallback = 0
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes=processes) as pool:
+        targets = [filenames[z] for z in modified]
+        converted = []
+        for image, n in tqdm.tqdm(bounded_imap(pool, converter, targets, 2 * processes), total=len(targets), desc='Converting modified'):
+            converted.append(image)
+            n_fallback += n
+        if any([image.shape != volume.shape[1:] for image in converted]):
+            raise RuntimeError('Modified section has a different size. Delete {} to rebuild.'.format(_manifest_filename(output)))
+        if not appended:
+            if modified:
+                mhd.patch(output, modified, np.stack(converted), n_workers=processes)
+        else:
+            n_fallback += _append_slices(output, volume, dict(zip(modified, converted)),
+                           bounded_imap(pool, converter, [filenames[z] for z in appended], 2 * processes), len(filenames), processes)
+    _write_manifest(output, filenames, settings, digests, processes)
+    return n_fallback
+
+class _NewSlices(object):
+    """Iterate over converted new sections as slabs, counting the pixels converted by the nearest color search."""
+    def __init__(self, results, shape, total):
+        self.results = results
+        self.shape = shape
+        self.total = total
+        self.n_fallback = 0
+    def __iter__(self):
+        for image, n in tqdm.tqdm(self.results, total=self.total, desc='Appending'):
+            if image.shape != self.shape:
+                raise RuntimeError('New section has a different size.')
+            self.n_fallback += n
+            yield image[None]
+
+def _append_slices(output, volume, replaced, new_slices, n_slices, processes=None):
+    """Append slices to the output and replace some without re-converting the others.
+
+    Chunks of chunked output are copied without decoding, except the last
+    one and the ones with replaced slices (see ``mhd.append``).
+
+    Returns:
+        int: The number of pixels of the appended slices converted by the nearest color search.
+    """
+    slices = _NewSlices(new_slices, volume.shape[1:], n_slices - len(volume))
+    indices = sorted(replaced)
+    mhd.append(output, slices, n_slices - len(volume), indices, [replaced[z] for z in indices], n_workers=processes)
+    return slices.n_fallback
 
 def process_input(args):
     filenames = None
@@ -59,9 +404,13 @@ def convert(is_label):
     parser.add_argument('--ext', help='File extension for image files. Default:%(default)s',metavar='<extension>',default='.png')
     parser.add_argument('--colormap', help='Colormap file for converting label image.',metavar='<filename>',required=False)
     parser.add_argument('--stride',help='Stride size for downsampling. Default:%(default)s',metavar='<n>',type=int,default=4)
+    parser.add_argument('--downsample',help='Downsampling method. "area" averages pixels and is meant for intensity images. Default:%(default)s',choices=['point','area'],default='point')
     parser.add_argument('--spacing',help='Spacing (voxel size) for the output image',metavar='<mm>',type=float,default=None,nargs='*')
     parser.add_argument('--exclude',help='Pattern(s) to be excluded',metavar='<pattern>',nargs='*')
     parser.add_argument('--channel',help='Output only specified channel(s)',metavar='<n>',nargs='*')
+    parser.add_argument('--chunk_slabs',help='Compress every n slices independently (see mhd.write). Default: 8 with --incremental',metavar='<n>',type=int)
+    parser.add_argument('--n_workers',help='Number of worker processes. Default: cpu count',metavar='<n>',type=int)
+    parser.add_argument('--incremental',help='Re-convert only modified sections and append new ones',action='store_true')
 
     args = parser.parse_args()
     filenames = process_input(args)
@@ -69,11 +418,9 @@ def convert(is_label):
         for e in args.exclude:
             filenames = [filename for filename in filenames if not e in filename]
 
-    volume = load_images(filenames,args.stride)
     header = {}
     header['TransformMatrix'] = '-1 0 0 0 -1 0 0 0 1' #for 3DSlicer
-    if args.channel:
-        volume = volume[:,:,:,int(args.channel[0])]
+    channel = int(args.channel[0]) if args.channel else None
 
     if args.spacing is not None:
         header['ElementSpacing'] = args.spacing
@@ -81,14 +428,21 @@ def convert(is_label):
         if args.colormap is None:
             args.colormap = os.path.join(os.path.dirname(__file__), 'colormap.csv')
         cmap = np.loadtxt(args.colormap, delimiter=',')
-        volume = to_label(volume, cmap)
         header['CompressedData'] = True
     else:
+        cmap = None
         header['CompressedData'] = False
-        if volume.shape[-1] == 3:
-            header['ElementNumberOfChannels'] = volume.shape[-1]
 
-    mhd.write(args.output,volume,header)
+    converter = SliceConverter(args.stride, channel, cmap, args.downsample)
+    if args.incremental:
+        chunk_slabs = args.chunk_slabs or (8 if header['CompressedData'] else None)
+        settings = {'stride': args.stride, 'channel': channel, 'downsample': args.downsample,
+                    'colormap': None if cmap is None else cmap.tolist()}
+        n_fallback = update_images(filenames, args.output, converter, header, chunk_slabs, settings, args.n_workers)
+    else:
+        n_fallback = convert_images(filenames, args.output, converter, header, args.chunk_slabs, args.n_workers)
+    if is_label:
+        print('{} pixel(s) had no exact match in the colormap and were converted to the nearest color.'.format(n_fallback))
 
 def img2mhd():
     return convert(False)
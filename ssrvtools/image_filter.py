@@ -7,7 +7,7 @@ def median_filter():
     parser.add_argument('-s','--size', help="Optional argument. Default:%(default)s",metavar='<n>',default=3,type=int)
 
     args = parser.parse_args()
-    import mhd
+    from ssrvtools import mhd
     from scipy.ndimage.filters import median_filter
     image, h = mhd.read(args.input)
     filtered =  median_filter(image, args.size)
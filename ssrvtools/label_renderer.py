@@ -0,0 +1,110 @@
+import argparse
+import os
+import functools
+import multiprocessing
+import tqdm
+import numpy as np
+from PIL import Image
+from ssrvtools import mhd
+from ssrvtools.shared_array import bounded_imap
+
+@functools.lru_cache()
+def _gist_ncar():
+    # matplotlib.pyplot is not needed (and slow to import) for a colormap table
+    try:
+        from matplotlib import colormaps
+        cmap = colormaps['gist_ncar']
+    except ImportError:
+        from matplotlib import cm
+        cmap = cm.get_cmap('gist_ncar')
+    lut = cmap(np.arange(256))
+    return np.clip(np.round(lut*255),0,255).astype(np.uint8)
+
+@functools.lru_cache(maxsize=32)
+def _palette(n_labels, seed):
+    vals = np.linspace(0,255,n_labels+1).astype(np.int32)
+    np.random.RandomState(seed).shuffle(vals)
+    palette = _gist_ncar()[vals]
+    palette[0] = 0
+    palette.flags.writeable = False
+    return palette
+
+def palette(n_labels, seed=0):
+    """RGBA palette for labels.
+
+    Colors are taken from gist_ncar at evenly spaced positions in a random order.
+    Palettes are cached per label count and seed.
+
+    Args:
+        n_labels (int): The largest label.
+        seed (int): Seed for the color order.
+    Returns:
+        np.ndarray: uint8 array of shape (n_labels+1, 4). Label 0 is transparent black.
+    """
+    return _palette(int(n_labels), seed)
+
+def render(labels, seed=0, n_labels=None):
+    """Render labels as an RGBA image.
+
+    Args:
+        labels (ndarray): Labels.
+        seed (int): Seed for the color order.
+        n_labels (int): The largest label. Pass the same value to get the same colors across images. Default: max of labels.
+    Returns:
+        np.ndarray: uint8 RGBA image.
+    """
+    if n_labels is None:
+        n_labels = np.max(labels) if labels.size > 0 else 0
+    return palette(n_labels, seed)[labels]
+
+class _SliceRenderer(object):
+    """Render a slice and save it as an image file."""
+    def __init__(self, palette, filename_format):
+        self.palette = palette
+        self.filename_format = filename_format
+    def __call__(self, args):
+        z, labels = args
+        filename = self.filename_format.format(z)
+        Image.fromarray(self.palette[labels]).save(filename)
+        return filename
+
+def render_volume(filename, output_dir, seed=0, ext='.png', processes=None):
+    """Render a label volume into an image stack.
+
+    Slices are read one at a time and are rendered and saved in worker processes.
+
+    Args:
+        filename (str): Label volume filename (mhd or mha).
+        output_dir (str): Output directory. Slices are saved as <z>.<ext> with zero padded z.
+        seed (int): Seed for the color order.
+        ext (str): Image file extension.
+        processes (int): Number of worker processes. Default: cpu count.
+    Returns:
+        list: Output filenames.
+    """
+    volume, _ = mhd.read_lazy(filename)
+    if volume.ndim != 3:
+        raise ValueError('{} is not a volume'.format(filename))
+    n_labels = max(int(np.max(block)) for block in volume.iter_slabs(16))
+    os.makedirs(output_dir, exist_ok=True)
+    digits = max(4, len(str(len(volume)-1)))
+    renderer = _SliceRenderer(palette(n_labels, seed), os.path.join(output_dir, '{:0'+str(digits)+'d}'+ext))
+
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes=processes) as pool:
+        slices = ((z, labels[0]) for z, labels in enumerate(volume.iter_slabs()))
+        return list(tqdm.tqdm(bounded_imap(pool, renderer, slices, 2 * processes), total=len(volume), desc='Rendering'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Render label volume into color images.')
+    parser.add_argument('input', help='Input label volume (mhd or mha)',metavar='<input>')
+    parser.add_argument('output', help='Output directory',metavar='<output>')
+    parser.add_argument('--ext', help='File extension for output images. Default:%(default)s',metavar='<extension>',default='.png')
+    parser.add_argument('--seed', help='Seed for the color order. Default:%(default)s',metavar='<n>',type=int,default=0)
+    parser.add_argument('--n_workers', help='Number of worker processes. Default: cpu count',metavar='<n>',type=int)
+
+    args = parser.parse_args()
+    render_volume(args.input, args.output, args.seed, args.ext, args.n_workers)
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,16 @@ Read/Write Meta Image
 """
 
 import re
+import sys
 import numpy as np
 import zlib
 import os
 import copy
 import warnings
+import collections
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 _metatype2dtype_table = {
     'MET_CHAR':'i1',
@@ -90,71 +95,357 @@ def _get_dim(header):
         dim = [header['ElementNumberOfChannels']] + dim
     return dim
 
-def read_memmap(filename):
+def _is_compressed(header):
+    return 'CompressedData' in header and header['CompressedData']
+
+def _data_location(filename, header):
+    """Locate the element data of a meta image.
+
+    :return: data filename and the byte offset of the data in it.
+    :rtype: (str, int)
+    """
+    data_filename = header['ElementDataFile']
+    if data_filename == 'LOCAL': #mha
+        if _is_compressed(header):
+            data_size = header['CompressedDataSize']
+        else:
+            numel = np.prod(np.array(_get_dim(header)))
+            data_size = numel * np.dtype(_metatype2dtype_table[header['ElementType']]).itemsize
+        return filename, os.path.getsize(filename) - data_size
+    if not os.path.isabs(data_filename): # data_filename is relative
+        data_filename = os.path.join(os.path.dirname(filename), data_filename)
+    return data_filename, 0
+
+def read_memmap(filename, mode='r'):
     """Read Meta Image as a memory-map.
 
     :param str filename: Image filename with extension mhd or mha.
+    :param str [mode]: (optional) Memory-map mode. 'r+' to modify the image in place.
     :return: ND image and meta data.
     :rtype: (numpy.memmap, dict)
     :raises: RuntimeError if image data is compressed
     """
     header = read_header(filename)
-    data_is_compressed = 'CompressedData' in header and header['CompressedData']
-    if data_is_compressed:
+    if _is_compressed(header):
         raise RuntimeError('Memory-map cannot be created for compressed data.')
     dtype = np.dtype(_metatype2dtype_table[header['ElementType']])
-    data_filename = header['ElementDataFile']
-    if data_filename == 'LOCAL': #mha
-        numel = np.prod(np.array(_get_dim(header)))
-        data_size = numel * dtype.itemsize
-        offset = os.path.getsize(filename) - data_size
-        data_filename = filename
-    else:
-        offset = 0
-        if not os.path.isabs(data_filename): # data_filename is relative
-            data_filename = os.path.join(os.path.dirname(filename), data_filename)
+    data_filename, offset = _data_location(filename, header)
     dim = _get_dim(header)
-    return np.memmap(data_filename, dtype=dtype, mode='r', shape=tuple(dim[::-1]), offset=offset), header
+    return np.memmap(data_filename, dtype=dtype, mode=mode, shape=tuple(dim[::-1]), offset=offset), header
+
+_stream_chunk_size = 2**24 # bytes processed at once while streaming (de)compression
+_decompress_chunk_size = 2**20 # compressed bytes read and decompressed bytes returned at once
+
+def _iter_decompressed(f, compressed_size):
+    """Decompress a zlib stream chunk by chunk.
+
+    :param file f: File object positioned at the beginning of the stream.
+    :param int compressed_size: Size of the compressed stream in bytes.
+    :return: Generator of decompressed bytes.
+    """
+    d = zlib.decompressobj()
+    remaining = compressed_size
+    while not d.eof:
+        if d.unconsumed_tail:
+            chunk = d.unconsumed_tail
+        elif remaining > 0:
+            chunk = f.read(min(remaining, _decompress_chunk_size))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+        else:
+            break
+        data = d.decompress(chunk, _decompress_chunk_size) # bound the size of decompressed chunk
+        if data:
+            yield data
+    data = d.flush()
+    if data:
+        yield data
+
+class LazyVolume(object):
+    """Meta Image whose element data is read on indexing.
 
-def read(filename):
+    Indexing follows numpy's semantics. Only the slabs (elements along the
+    first axis, i.e. z-slices for a volume) selected by the first index are
+    read. Uncompressed data is read through a memory-map so that only the
+    selected bytes are touched. Compressed data is decompressed as a stream
+    which is abandoned once the last selected slab has been decoded.
+
+    >>> volume, header = read_lazy('label.mha')
+    >>> sub = volume[100:120, 512:1024, 512:1024]
+    """
+    def __init__(self, filename, header=None):
+        self.filename = filename
+        self.header = read_header(filename) if header is None else header
+        self.dtype = np.dtype(_metatype2dtype_table[self.header['ElementType']])
+        self.shape = tuple(_get_dim(self.header)[::-1])
+        self.compressed = _is_compressed(self.header)
+        self.data_filename, self.offset = _data_location(filename, self.header)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def slab_nbytes(self):
+        return int(np.prod(self.shape[1:])) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        image = self[...]
+        return image if dtype is None else image.astype(dtype)
+
+    def _split_key(self, key):
+        """Split index into the one for the first axis and the rest."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) == 0 or key[0] is Ellipsis:
+            return slice(None), key
+        if key[0] is None:
+            raise IndexError('np.newaxis is not supported on the first axis.')
+        return key[0], key[1:]
+
+    def __getitem__(self, key):
+        first, rest = self._split_key(key)
+        if not self.compressed:
+            mm = np.memmap(self.data_filename, dtype=self.dtype, mode='r', shape=self.shape, offset=self.offset)
+            return np.array(mm[(first,) + rest])
+        indices = np.arange(self.shape[0])[first]
+        unique_indices = np.unique(indices)
+        slabs = self._read_slabs(unique_indices)
+        if np.ndim(indices) == 0:
+            return slabs[0][rest]
+        return slabs[np.searchsorted(unique_indices, indices)][(slice(None),) + rest]
+
+    def _read_chunked_slabs(self, indices):
+        """Read sorted unique slabs by decompressing only the chunks containing them."""
+        chunk_slabs = self.header['CompressedDataChunkSlabs']
+        chunk_ids = np.unique(indices // chunk_slabs)
+        chunks = np.empty((len(chunk_ids) * chunk_slabs,) + self.shape[1:], dtype=self.dtype)
+        _decompress_chunks(self.data_filename, self.offset, self.header, chunk_ids,
+                           chunks.reshape((len(chunks), -1)).view(np.uint8))
+        return chunks[np.searchsorted(chunk_ids, indices // chunk_slabs) * chunk_slabs + indices % chunk_slabs]
+
+    def _read_slabs(self, indices):
+        """Read sorted unique slabs from the compressed stream."""
+        if _is_chunked(self.header):
+            return self._read_chunked_slabs(indices)
+        slabs = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        if len(indices) == 0:
+            return slabs
+        out = slabs.reshape((len(indices), -1)).view(np.uint8)
+        slab_nbytes = self.slab_nbytes
+        pos = 0 # position in the decompressed stream
+        with open(self.data_filename, 'rb') as f:
+            f.seek(self.offset)
+            compressed_size = self.header.get('CompressedDataSize', os.path.getsize(self.data_filename) - self.offset)
+            for data in _iter_decompressed(f, compressed_size):
+                end = pos + len(data)
+                first_slab, last_slab = pos // slab_nbytes, (end - 1) // slab_nbytes
+                lo, hi = np.searchsorted(indices, [first_slab, last_slab], side='left')
+                for i in range(lo, min(hi + 1, len(indices))):
+                    z = indices[i]
+                    if z > last_slab:
+                        break
+                    s = max(pos, z * slab_nbytes)
+                    e = min(end, (z + 1) * slab_nbytes)
+                    out[i, s - z * slab_nbytes:e - z * slab_nbytes] = np.frombuffer(data, dtype=np.uint8, count=e - s, offset=s - pos)
+                pos = end
+                if pos >= (indices[-1] + 1) * slab_nbytes:
+                    break
+        if pos < (indices[-1] + 1) * slab_nbytes:
+            raise RuntimeError('Compressed data is truncated: ' + self.data_filename)
+        return slabs
+
+    def _iter_stream_blocks(self):
+        """Decompress the whole stream, yielding blocks of complete slabs in order."""
+        slab_nbytes = self.slab_nbytes
+        pending = bytearray()
+        with open(self.data_filename, 'rb') as f:
+            f.seek(self.offset)
+            compressed_size = self.header.get('CompressedDataSize', os.path.getsize(self.data_filename) - self.offset)
+            for data in _iter_decompressed(f, compressed_size):
+                pending += data
+                n = len(pending) // slab_nbytes
+                if n > 0:
+                    block = np.frombuffer(pending, dtype=self.dtype, count=n * slab_nbytes // self.dtype.itemsize).copy()
+                    del pending[:n * slab_nbytes]
+                    yield block.reshape((n,) + self.shape[1:])
+
+    def iter_slabs(self, n_slabs=1):
+        """Iterate over the image in blocks of ``n_slabs`` slabs.
+
+        Unlike indexing block by block, compressed data is decompressed only
+        once. The last block may be shorter.
+
+        :param int n_slabs: The number of slabs per block.
+        :return: Generator of numpy.ndarray.
+        """
+        if not self.compressed:
+            for z in range(0, len(self), n_slabs):
+                yield self[z:z+n_slabs]
+            return
+        if _is_chunked(self.header):
+            chunk_slabs = self.header['CompressedDataChunkSlabs']
+            blocks = (self._read_chunked_slabs(np.arange(z, min(z + chunk_slabs, len(self)))) for z in range(0, len(self), chunk_slabs))
+        else:
+            blocks = self._iter_stream_blocks()
+        # slices of a decoded block are yielded as they are, and only slabs
+        # spanning block boundaries are concatenated
+        pending = []
+        n_pending = 0
+        for block in blocks:
+            start = 0
+            if n_pending > 0:
+                start = min(len(block), n_slabs - n_pending)
+                pending.append(block[:start])
+                n_pending += start
+                if n_pending < n_slabs:
+                    continue
+                yield np.concatenate(pending)
+                pending = []
+                n_pending = 0
+            while len(block) - start >= n_slabs:
+                yield block[start:start+n_slabs]
+                start += n_slabs
+            if start < len(block):
+                pending = [block[start:]]
+                n_pending = len(block) - start
+        if n_pending > 0:
+            yield np.concatenate(pending)
+
+def read_lazy(filename):
+    """Read Meta Image lazily.
+
+    :param str filename: Image filename with extension mhd or mha.
+    :return: Lazily loaded ND image and meta data.
+    :rtype: (LazyVolume, dict)
+    """
+    volume = LazyVolume(filename)
+    return volume, volume.header
+
+def read(filename, out=None):
     """Read Meta Image.
 
     :param str filename: Image filename with extension mhd or mha.
-    :return: ND image and meta data.
+    :param numpy.ndarray [out]: (optional) C-contiguous array of the image's shape and dtype to read into, e.g. on shared memory.
+    :return: ND image (``out`` if given) and meta data.
     :rtype: (numpy.ndarray, dict)
     """
     header = read_header(filename)
-    data_is_compressed = 'CompressedData' in header and header['CompressedData']
-    data_filename = header['ElementDataFile']
-    if data_filename == 'LOCAL': #mha
-        if data_is_compressed:
-            data_size = header['CompressedDataSize']
-        else:
-            numel = np.prod(np.array(_get_dim(header)))
-            data_size = numel * np.dtype(_metatype2dtype_table[header['ElementType']]).itemsize
-        seek_size = os.path.getsize(filename) - data_size
-        with open(filename, 'rb') as f:
-            f.seek(seek_size)
-            data = f.read()
-    else: #mhd
-        if not os.path.isabs(data_filename): # data_filename is relative
-            data_filename = os.path.join(os.path.dirname(filename), data_filename)
-        with open(data_filename,  'rb') as fimage:
-            data = fimage.read()
-    if data_is_compressed:
-        try:
-            import pylibdeflate
-            numel = np.prod(np.array(_get_dim(header)))
-            decompressed_size = numel * np.dtype(_metatype2dtype_table[header['ElementType']]).itemsize
-            data = pylibdeflate.zlib_decompress(data, decompressed_size)
-        except:
-            data = zlib.decompressobj().decompress(data)
-    data = np.frombuffer(data,dtype=np.dtype(_metatype2dtype_table[header['ElementType']]))
-    dim = _get_dim(header)
-    image = np.reshape(data,list(reversed(dim)),order='C')
-    image.setflags(write=1)
+    dtype = np.dtype(_metatype2dtype_table[header['ElementType']])
+    shape = tuple(_get_dim(header)[::-1])
+    if out is None:
+        image = np.empty(shape, dtype=dtype)
+    elif out.shape != shape or out.dtype != dtype or not out.flags.c_contiguous:
+        raise ValueError('Output array of shape {} and {} does not match the image of shape {} and {}.'.format(out.shape, out.dtype, shape, dtype))
+    else:
+        image = out
+    buffer = image.reshape(-1).view(np.uint8)
+    data_filename, offset = _data_location(filename, header)
+    with open(data_filename, 'rb') as f:
+        f.seek(offset)
+        if _is_chunked(header):
+            slabs = image.reshape((len(image), -1)).view(np.uint8)
+            _decompress_chunks(data_filename, offset, header, range(len(_chunk_ranges(header))), slabs)
+        elif _is_compressed(header):
+            compressed_size = header.get('CompressedDataSize', os.path.getsize(data_filename) - offset)
+            if not _pylibdeflate_decompress_into(f, compressed_size, buffer):
+                f.seek(offset)
+                _decompress_into(f, compressed_size, buffer)
+        elif f.readinto(buffer) != buffer.size:
+            raise RuntimeError('Image data is truncated: ' + data_filename)
     return image, header
 
+def _is_chunked(header):
+    return _is_compressed(header) and 'CompressedDataChunkOffsets' in header
+
+def _chunk_ranges(header):
+    """Byte ranges of the compressed chunks relative to the beginning of the data."""
+    offsets = list(np.atleast_1d(header['CompressedDataChunkOffsets']))
+    ends = offsets[1:] + [header['CompressedDataSize'] - 4] # exclude adler32 checksum
+    return list(zip(offsets, ends))
+
+class _ChunkDecompressor(object):
+    def __init__(self, data_filename, offset):
+        self.data_filename = data_filename
+        self.offset = offset
+    def __call__(self, args):
+        (start, end), out = args
+        with open(self.data_filename, 'rb') as f:
+            f.seek(self.offset + start)
+            compressed = f.read(end - start)
+        data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(compressed, out.size)
+        if len(data) != out.size:
+            raise RuntimeError('Compressed chunk is truncated: ' + self.data_filename)
+        out[:] = np.frombuffer(data, dtype=np.uint8)
+
+def _decompress_chunks(data_filename, offset, header, chunk_ids, slabs, n_workers=None):
+    """Decompress chunks of chunked data in parallel.
+
+    :param list chunk_ids: Chunks to be decompressed.
+    :param numpy.ndarray slabs: uint8 array of shape (n_slabs, slab_nbytes)
+        receiving the chunks in the order of ``chunk_ids``.
+    """
+    chunk_slabs = header['CompressedDataChunkSlabs']
+    n_slabs = _get_dim(header)[-1]
+    ranges = _chunk_ranges(header)
+    tasks = []
+    for i, chunk_id in enumerate(chunk_ids):
+        length = min(chunk_slabs, n_slabs - chunk_id * chunk_slabs)
+        tasks.append((ranges[chunk_id], slabs[i*chunk_slabs:i*chunk_slabs+length].reshape(-1)))
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+        list(executor.map(_ChunkDecompressor(data_filename, offset), tasks))
+
+_pylibdeflate_max_size = 2**28 # larger images are decompressed by streaming zlib
+
+def _pylibdeflate_decompress_into(f, compressed_size, buffer):
+    """Decompress a zlib stream into a preallocated buffer with pylibdeflate.
+
+    pylibdeflate is faster than zlib but has no streaming interface and
+    returns a new bytes object, so the compressed data, the decompressed
+    data and the image are held at the same time (over 2x the image).
+    Images larger than ``_pylibdeflate_max_size`` are left to zlib.
+
+    :return: False if pylibdeflate is not available, fails or the image is too large. ``f`` has to be rewound then.
+    :rtype: bool
+    """
+    if buffer.size > _pylibdeflate_max_size:
+        return False
+    try:
+        import pylibdeflate
+    except ImportError:
+        return False
+    try:
+        data = pylibdeflate.zlib_decompress(f.read(compressed_size), buffer.size)
+    except Exception:
+        return False
+    if len(data) != buffer.size:
+        return False
+    buffer[:] = np.frombuffer(data, dtype=np.uint8)
+    return True
+
+def _decompress_into(f, compressed_size, buffer):
+    """Decompress a zlib stream into a preallocated buffer with zlib.
+
+    The stream is decompressed chunk by chunk, so only the image and a few
+    ``_decompress_chunk_size`` buffers are held in memory.
+
+    :param file f: File object positioned at the beginning of the stream.
+    :param int compressed_size: Size of the compressed stream in bytes.
+    :param numpy.ndarray buffer: 1D uint8 array receiving decompressed data.
+    """
+    pos = 0
+    for data in _iter_decompressed(f, compressed_size):
+        if pos + len(data) > buffer.size:
+            raise RuntimeError('Decompressed data is larger than the image.')
+        buffer[pos:pos + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        pos += len(data)
+    if pos != buffer.size:
+        raise RuntimeError('Compressed data is truncated.')
+
 _default_header = {
     'ObjectType':'Image',
     'BinaryData':'True',
@@ -165,70 +456,568 @@ _no_compression_types = set(['float32','float64']) #takes long time to compress
 def _is_compression_preferable(np_dtype):
     return not (np_dtype in _no_compression_types)
 
+_compressed_data_keys = ['CompressedDataSize', 'CompressedDataChunkSlabs', 'CompressedDataChunkOffsets', 'CompressedDataChunkChecksums']
+
+def _caller_stacklevel():
+    """``stacklevel`` of a warning issued by the caller of this function, pointing at the first frame outside this module.
+
+    Public functions of this module call each other (e.g. ``write`` creates
+    a ``Writer``), so a fixed stacklevel would blame this module.
+    """
+    frame = sys._getframe(1)
+    level = 1
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+        level += 1
+    return level
+
 def _check_header_sanity(header):
     n_dims_spacing = len(_str2array(header['ElementSpacing']))
     if n_dims_spacing != int(header['NDims']):
-        warnings.warn('The number of elements of "ElementSpacing" doesn\'t match "NDims". {0} vs {1}'.format(n_dims_spacing,header['NDims']), stacklevel=3)
+        warnings.warn('The number of elements of "ElementSpacing" doesn\'t match "NDims". {0} vs {1}'.format(n_dims_spacing,header['NDims']), stacklevel=_caller_stacklevel())
 
-def write(filename, image, header={}):
+def write(filename, image, header={}, chunk_slabs=None, compression_level=None, n_workers=None):
     """Write Meta Image.
 
+    When ``chunk_slabs`` is given, compressed data is split into chunks of
+    ``chunk_slabs`` slabs which are deflated independently in a thread pool.
+    The chunks are flushed so that they concatenate into a single ordinary
+    zlib stream, which keeps the file readable by VTK and 3D Slicer, and
+    their offsets are recorded in the header for parallel and random access
+    reads. Adler-32 checksums of the chunks are recorded as well, so that
+    ``patch`` and ``append`` can copy chunks without decoding them.
+    ``chunk_slabs`` is raised if needed to keep the number of chunks within
+    what MetaIO can read from the header (about 2700).
+
     :param str filename: Image filename with extension mhd or mha.
     :param numpy.ndarray image: Image to be written.
     :param dict [header]: (optional) Meta data for the image.
+    :param int [chunk_slabs]: (optional) Number of slabs per compressed chunk.
+    :param int [compression_level]: (optional) zlib compression level (0-9).
+    :param int [n_workers]: (optional) Number of compression threads. Default: cpu count.
     """
-    if image.dtype == np.bool:
-        image = image.astype(np.uint8)
-    # Construct header
+    with Writer(filename, image.shape, image.dtype, header, chunk_slabs, compression_level, n_workers) as writer:
+        writer.write(image)
+
+def _construct_header(shape, dtype, header, compress_data):
+    """Merge default, given and image dependent meta data.
+
+    :return: meta data dictionary with string values.
+    :rtype: dict
+    """
+    ndim = len(shape)
     h = copy.deepcopy(_default_header)
-    h['ElementSpacing'] = np.ones(image.ndim-1) if ('ElementNumberOfChannels') in header else np.ones(image.ndim) # default spacing
-    h['CompressedData'] = _is_compression_preferable(image.dtype.name) #default compression option
+    h['ElementSpacing'] = np.ones(ndim-1) if ('ElementNumberOfChannels') in header else np.ones(ndim) # default spacing
+    h['CompressedData'] = compress_data #default compression option
     # Merge default and given headers
     h.update(header)
     # Set image dependent meta data
-    h['NDims'] = len(image.shape)
-    h['ElementType'] = _dtype2metatype_table[image.dtype.name]
+    h['NDims'] = ndim
+    h['ElementType'] = _dtype2metatype_table[np.dtype(dtype).name]
     if ('ElementNumberOfChannels') in h:
-        h['ElementNumberOfChannels'] = image.shape[-1]
-        h['DimSize'] = reversed(image.shape[:-1])
+        h['ElementNumberOfChannels'] = shape[-1]
+        h['DimSize'] = reversed(shape[:-1])
         h['NDims'] -= 1
     else:
-        h['DimSize'] = reversed(image.shape)
+        h['DimSize'] = reversed(shape)
     h.pop('ElementDataFile',None) #delete 'ElementDataFile'
-    h.pop('CompressedDataSize', None)
-    h = {key:_array2str(value) for (key, value) in h.items()} #convert array into string if possible
+    for key in _compressed_data_keys:
+        h.pop(key, None)
+    return {key:_array2str(value) for (key, value) in h.items()} #convert array into string if possible
+
+def _get_data_filename(filename, compress_data):
     filename_base, file_extension = os.path.splitext(filename)
-    compress_data = (h['CompressedData'] == 'True') #boolean variable for convenience
     if (file_extension == '.mhd'):
         if (compress_data):
-            data_filename = filename_base + '.zraw'
+            return filename_base + '.zraw'
         else:
-            data_filename = filename_base + '.raw'
-    else:
-        if (file_extension != '.mha'):
-            warnings.warn('Unknown file extension "{0}". Saving as a .mha file.'.format(file_extension), stacklevel=2)
-        data_filename = 'LOCAL'
-    data = image.tobytes()
-    if (compress_data):
-        try:
-            import pylibdeflate
-            data = pylibdeflate.zlib_compress(data)
-        except:
-            data = zlib.compress(data)
-        h['CompressedDataSize'] = str(len(data))
+            return filename_base + '.raw'
+    if (file_extension != '.mha'):
+        warnings.warn('Unknown file extension "{0}". Saving as a .mha file.'.format(file_extension), stacklevel=_caller_stacklevel())
+    return 'LOCAL'
+
+def create_memmap(filename, shape, dtype, header={}):
+    """Create Meta Image and return its data as a writable memory-map.
+
+    The header is written and the (uncompressed) data file is preallocated,
+    so that a large image can be filled part by part with bounded memory.
+    The resulting file can be opened by ``read_memmap``.
+
+    :param str filename: Image filename with extension mhd or mha.
+    :param tuple shape: Shape of the image.
+    :param dtype: Data type of the image.
+    :param dict [header]: (optional) Meta data for the image.
+    :return: Writable memory-map of the image data.
+    :rtype: numpy.memmap
+    """
+    dtype = np.dtype(np.uint8 if np.dtype(dtype) == np.bool_ else dtype)
+    shape = tuple(shape)
+    h = _construct_header(shape, dtype, header, False)
+    h['CompressedData'] = 'False' # memory-map needs uncompressed data
+    data_filename = _get_data_filename(filename, False)
     _check_header_sanity(h)
-    with open(filename, 'w') as f:
-        #write first two meta data
-        f.write('ObjectType = '+h.pop('ObjectType')+'\n')
-        f.write('NDims = '+h.pop('NDims')+'\n')
-        for key, value in h.items(): #write other meta data
-            f.write(key+' = '+value+'\n')
-        f.write('ElementDataFile = '+os.path.basename(data_filename)+'\n') #write last meta data
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    with open(filename, 'wb') as f:
+        _write_header(f, h, data_filename)
+        offset = f.tell()
         if data_filename == 'LOCAL':
-            # reopen file in binary mode
-            f.close()
-            with open(filename, 'ab') as fdata:
-                fdata.write(data)
+            f.truncate(offset + nbytes)
+            data_filename = filename
         else:
+            offset = 0
             with open(data_filename, 'wb') as fdata:
-                fdata.write(data)
+                fdata.truncate(nbytes)
+    return np.memmap(data_filename, dtype=dtype, mode='r+', shape=shape, offset=offset)
+
+def _size_placeholder(size):
+    """Format size in fixed width so that the header can be rewritten in place."""
+    return '{:>20}'.format(size)
+
+_max_header_value_length = 32767 # MetaIO (VTK, ITK, Slicer) fails to parse longer values
+
+def _chunk_field_width(nbytes, n_chunks):
+    """Width of chunk offsets and checksums large enough for any compressed data."""
+    max_size = nbytes + (nbytes >> 10) + 64 * n_chunks + 6 # bound of deflated size with a flush per chunk
+    return max(len(str(max_size)), len(str(0xffffffff)))
+
+def _max_chunks(nbytes, n_slabs):
+    """The largest number of chunks whose offsets fit in a header value."""
+    width = _chunk_field_width(nbytes, n_slabs)
+    return max(1, (_max_header_value_length + 1) // (width + 1))
+
+def _chunk_list(values, width):
+    """Format chunk offsets or checksums in fixed width so that the header can be rewritten in place."""
+    value = ' '.join(['{:>{}}'.format(v, width) for v in values])
+    if len(value) > _max_header_value_length:
+        raise ValueError('{} chunks do not fit in the header. Use larger chunk_slabs.'.format(len(values)))
+    return value
+
+def _write_header(f, h, data_filename):
+    h = dict(h)
+    #write first two meta data
+    f.write(('ObjectType = '+h.pop('ObjectType')+'\n').encode('ascii'))
+    f.write(('NDims = '+h.pop('NDims')+'\n').encode('ascii'))
+    for key, value in h.items(): #write other meta data
+        f.write((key+' = '+value+'\n').encode('ascii'))
+    f.write(('ElementDataFile = '+os.path.basename(data_filename)+'\n').encode('ascii')) #write last meta data
+
+def _iter_buffers(image):
+    """Iterate over the image data in C order as contiguous uint8 chunks.
+
+    At most one slab (an element along the first axis) is copied at a time
+    for non-contiguous images.
+    """
+    if image.ndim == 0:
+        image = image.reshape(1)
+    slab_nbytes = max(1, image[0].nbytes) if len(image) > 0 else 1
+    step = max(1, _stream_chunk_size // slab_nbytes)
+    for i in range(0, len(image), step):
+        block = np.ascontiguousarray(image[i:i+step]).reshape(-1).view(np.uint8)
+        for j in range(0, block.size, _stream_chunk_size):
+            yield block[j:j+_stream_chunk_size]
+
+def _adler32_combine(adler1, adler2, len2):
+    """Adler-32 checksum of concatenated data from checksums of the parts."""
+    base = 65521
+    sum1 = ((adler1 & 0xffff) + (adler2 & 0xffff) - 1) % base
+    sum2 = ((adler1 >> 16) + (adler2 >> 16) + (len2 % base) * ((adler1 & 0xffff) - 1)) % base
+    return sum1 | (sum2 << 16)
+
+def _compress_chunk(chunk, is_last, compression_level):
+    """Deflate a chunk so that it can be concatenated to the other chunks."""
+    buffer = chunk.reshape(-1).view(np.uint8)
+    c = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS) # raw deflate
+    # full flush byte-aligns the chunk and resets the dictionary, so chunks can be concatenated and decoded independently
+    data = c.compress(buffer) + c.flush(zlib.Z_FINISH if is_last else zlib.Z_FULL_FLUSH)
+    return data, zlib.adler32(buffer), buffer.size
+
+class Writer(object):
+    """Write Meta Image slab by slab.
+
+    Slabs (elements along the first axis) are written in order, so the whole
+    image never has to be in memory. Parameters are the same as ``write``.
+
+    >>> with Writer('label.mha', (len(filenames), 512, 512), np.uint8) as writer:
+    ...     for filename in filenames:
+    ...         writer.write(load(filename)[None])
+    """
+    def __init__(self, filename, shape, dtype, header={}, chunk_slabs=None, compression_level=None, n_workers=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.uint8 if np.dtype(dtype) == np.bool_ else dtype)
+        self.filename = filename
+        self.h = _construct_header(self.shape, self.dtype, header, chunk_slabs is not None or _is_compression_preferable(self.dtype.name))
+        self.compress_data = (self.h['CompressedData'] == 'True')
+        self.chunk_slabs = chunk_slabs if self.compress_data else None
+        self.compression_level = -1 if compression_level is None else compression_level
+        self.use_pylibdeflate = self.compress_data and compression_level is None and chunk_slabs is None
+        self.data_filename = _get_data_filename(filename, self.compress_data)
+        if (self.compress_data):
+            self.h['CompressedDataSize'] = _size_placeholder(0) # overwritten once the size is known
+        if (self.chunk_slabs):
+            nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            # fewer, larger chunks if the offsets would not fit in the header
+            self.chunk_slabs = max(self.chunk_slabs, -(-self.shape[0] // _max_chunks(nbytes, self.shape[0])))
+            n_chunks = -(-self.shape[0] // self.chunk_slabs)
+            self.chunk_width = _chunk_field_width(nbytes, n_chunks)
+            self.h['CompressedDataChunkSlabs'] = str(self.chunk_slabs)
+            self.h['CompressedDataChunkOffsets'] = _chunk_list([0] * n_chunks, self.chunk_width)
+            self.h['CompressedDataChunkChecksums'] = _chunk_list([0] * n_chunks, self.chunk_width)
+        _check_header_sanity(self.h)
+        self.f = open(filename, 'wb')
+        _write_header(self.f, self.h, self.data_filename)
+        self.fdata = self.f if self.data_filename == 'LOCAL' else open(self.data_filename, 'wb')
+        self.n_written = 0 # the number of slabs received
+        self.data_size = 0 # the number of bytes written
+        if self.chunk_slabs:
+            self.fdata.write(b'\x78\x9c') # zlib header (deflate, 32K window)
+            self.data_size = 2
+            self.n_workers = n_workers or os.cpu_count()
+            self.executor = ThreadPoolExecutor(max_workers=self.n_workers)
+            self.futures = collections.deque()
+            self.pending = []
+            self.offsets = []
+            self.checksums = []
+            self.checksum = zlib.adler32(b'')
+        elif self.compress_data:
+            self.compressor = zlib.compressobj(self.compression_level)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_files()
+
+    def _write(self, data):
+        self.fdata.write(data)
+        self.data_size += len(data)
+
+    def write(self, slabs):
+        """Append slabs to the image.
+
+        :param numpy.ndarray slabs: Array of shape ``(n,) + shape[1:]``.
+        """
+        if slabs.dtype == np.bool_:
+            slabs = slabs.view(np.uint8) # no copy
+        if slabs.shape[1:] != self.shape[1:] or self.n_written + len(slabs) > self.shape[0]:
+            raise ValueError('Slabs of shape {} do not fit in the image of shape {}.'.format(slabs.shape, self.shape))
+        slabs = slabs.astype(self.dtype, copy=False)
+        if self.chunk_slabs:
+            self._write_chunked(slabs)
+        elif self.use_pylibdeflate and self.n_written == 0 and len(slabs) == self.shape[0]:
+            # whole image at once
+            try:
+                import pylibdeflate
+                data = pylibdeflate.zlib_compress(np.ascontiguousarray(slabs).reshape(-1).view(np.uint8))
+            except Exception: # not available, or the buffer is not accepted
+                self.use_pylibdeflate = False
+                return self.write(slabs)
+            self._write(data)
+            self.compressor = None
+        else:
+            for chunk in _iter_buffers(slabs):
+                self._write(self.compressor.compress(chunk) if self.compress_data else chunk)
+        self.n_written += len(slabs)
+
+    def _write_chunked(self, slabs):
+        start = 0
+        while start < len(slabs):
+            n_pending = sum([len(e) for e in self.pending])
+            end = min(len(slabs), start + self.chunk_slabs - n_pending)
+            self.pending.append(slabs[start:end])
+            start = end
+            n_pending += len(self.pending[-1])
+            is_last = self.n_written + end == self.shape[0]
+            if n_pending == self.chunk_slabs or is_last:
+                chunk = np.concatenate(self.pending) # copy, the caller may reuse its buffer
+                self.pending = []
+                self._submit(_compress_chunk, chunk, is_last, self.compression_level)
+        if self.pending:
+            self.pending = [np.concatenate(self.pending)] # copy, the caller may reuse its buffer
+
+    def _submit(self, func, *args):
+        """Run ``func`` returning the same as ``_compress_chunk`` in the thread pool and write its chunk in order."""
+        self.futures.append(self.executor.submit(func, *args))
+        while len(self.futures) >= 2 * self.n_workers:
+            self._write_compressed_chunk(self.futures.popleft().result())
+
+    def _write_chunk_by(self, func, arg, n_slabs):
+        """Append a chunk of ``n_slabs`` slabs compressed (or copied) by ``func(arg)``."""
+        if self.pending or self.n_written % self.chunk_slabs != 0:
+            raise RuntimeError('Chunks can be appended only at chunk boundaries.')
+        self._submit(func, arg)
+        self.n_written += n_slabs
+
+    def _write_compressed_chunk(self, result):
+        data, adler, length = result
+        self.offsets.append(self.data_size)
+        self.checksums.append(adler)
+        self._write(data)
+        self.checksum = _adler32_combine(self.checksum, adler, length)
+
+    def _close_files(self):
+        if self.chunk_slabs:
+            self.executor.shutdown()
+        if self.fdata is not self.f:
+            self.fdata.close()
+        self.f.close()
+
+    def close(self):
+        """Finish the data and finalize the header."""
+        if self.n_written != self.shape[0]:
+            self._close_files()
+            raise RuntimeError('Only {} of {} slabs are written.'.format(self.n_written, self.shape[0]))
+        if self.chunk_slabs:
+            while self.futures:
+                self._write_compressed_chunk(self.futures.popleft().result())
+            self._write(self.checksum.to_bytes(4, 'big'))
+            self.h['CompressedDataChunkOffsets'] = _chunk_list(self.offsets, self.chunk_width)
+            self.h['CompressedDataChunkChecksums'] = _chunk_list(self.checksums, self.chunk_width)
+        elif self.compress_data and self.compressor is not None:
+            self._write(self.compressor.flush())
+        if self.compress_data:
+            self.h['CompressedDataSize'] = _size_placeholder(self.data_size)
+            self.f.seek(0)
+            _write_header(self.f, self.h, self.data_filename)
+        self._close_files()
+
+class _ChunkPatcher(object):
+    """Recompress a chunk with updated slabs, or pass its compressed bytes through."""
+    def __init__(self, volume, updates, compression_level):
+        self.volume = volume
+        self.updates = updates
+        self.compression_level = compression_level
+        self.ranges = _chunk_ranges(volume.header)
+        self.checksums = _chunk_checksums(volume.header)
+    def __call__(self, chunk_id):
+        chunk_slabs = self.volume.header['CompressedDataChunkSlabs']
+        is_last = chunk_id == len(self.ranges) - 1
+        indices = np.arange(chunk_id * chunk_slabs, min((chunk_id + 1) * chunk_slabs, len(self.volume)))
+        if chunk_id in self.updates:
+            chunk = self.volume._read_chunked_slabs(indices)[:len(indices)]
+            for z, slab in self.updates[chunk_id]:
+                chunk[z - indices[0]] = slab
+            return _compress_chunk(chunk, is_last, self.compression_level)
+        start, end = self.ranges[chunk_id]
+        with open(self.volume.data_filename, 'rb') as f:
+            f.seek(self.volume.offset + start)
+            data = f.read(end - start)
+        if self.checksums is not None:
+            return data, self.checksums[chunk_id], len(indices) * self.volume.slab_nbytes
+        decompressed = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data) # written without checksums
+        return data, zlib.adler32(decompressed), len(decompressed)
+
+def _chunk_checksums(header):
+    """Adler-32 checksums of the compressed chunks, or None if not recorded."""
+    if 'CompressedDataChunkChecksums' not in header:
+        return None
+    return [int(c) for c in np.atleast_1d(header['CompressedDataChunkChecksums'])]
+
+def _rewrite(filename, updates, new_slabs=(), n_new=0, compression_level=None, n_workers=None):
+    """Rewrite Meta Image with overwritten and appended slabs.
+
+    Chunks of chunked data without overwritten slabs are copied as they
+    are, except the last one when slabs are appended, because it finishes
+    the stream. Other data is decoded and compressed again.
+
+    :param dict updates: New slabs keyed by their indices.
+    :param iterable [new_slabs]: (optional) Arrays of shape ``(n,) + shape[1:]`` to be appended in order.
+    :param int [n_new]: (optional) The total number of slabs to be appended.
+    """
+    volume = LazyVolume(filename)
+    shape = (len(volume) + n_new,) + volume.shape[1:]
+    chunk_slabs = volume.header['CompressedDataChunkSlabs'] if _is_chunked(volume.header) else None
+    dirname = os.path.dirname(os.path.abspath(filename))
+    tmp_dir = tempfile.mkdtemp(dir=dirname)
+    try:
+        with Writer(os.path.join(tmp_dir, os.path.basename(filename)), shape, volume.dtype, volume.header, chunk_slabs, compression_level, n_workers) as writer:
+            z = 0
+            if chunk_slabs and writer.chunk_slabs == chunk_slabs: # chunks are merged if too many to fit in the header
+                chunk_updates = collections.defaultdict(list)
+                for i, slab in updates.items():
+                    chunk_updates[i // chunk_slabs].append((i, slab))
+                patcher = _ChunkPatcher(volume, chunk_updates, writer.compression_level)
+                n_copied = len(patcher.ranges) - (1 if n_new > 0 else 0)
+                for chunk_id in range(n_copied):
+                    n_slabs = min(chunk_slabs, len(volume) - z)
+                    writer._write_chunk_by(patcher, chunk_id, n_slabs)
+                    z += n_slabs
+            if z == 0:
+                blocks = volume.iter_slabs(max(1, chunk_slabs or 1))
+            else:
+                blocks = [volume[z:]] if z < len(volume) else [] # the last chunk to be continued
+            for block in blocks:
+                touched = [i for i in range(z, z + len(block)) if i in updates]
+                if touched:
+                    block = block.copy() # blocks may share memory with the reader
+                    for i in touched:
+                        block[i - z] = updates[i]
+                writer.write(block)
+                z += len(block)
+            for slabs in new_slabs:
+                writer.write(slabs)
+        for name in os.listdir(tmp_dir):
+            os.replace(os.path.join(tmp_dir, name), os.path.join(dirname, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def patch(filename, indices, slabs, compression_level=None, n_workers=None):
+    """Overwrite slabs of an existing Meta Image.
+
+    Uncompressed data is overwritten in place. For chunked compressed data
+    (see ``write``), only the chunks containing the slabs are recompressed
+    and the others are copied as they are.
+
+    :param str filename: Image filename with extension mhd or mha.
+    :param list indices: Indices of the slabs to be overwritten.
+    :param numpy.ndarray slabs: New slabs of shape ``(len(indices),) + shape[1:]``.
+    :param int [compression_level]: (optional) zlib compression level (0-9).
+    :param int [n_workers]: (optional) Number of compression threads. Default: cpu count.
+    :raises: RuntimeError if image data is compressed as a single stream
+    """
+    header = read_header(filename)
+    volume = LazyVolume(filename, header)
+    if not volume.compressed:
+        mm = np.memmap(volume.data_filename, dtype=volume.dtype, mode='r+', shape=volume.shape, offset=volume.offset)
+        mm[np.asarray(indices)] = slabs
+        mm.flush()
+        return
+    if not _is_chunked(header):
+        raise RuntimeError('Only uncompressed or chunked data can be patched.')
+    _rewrite(filename, dict(zip([int(z) for z in indices], slabs)), compression_level=compression_level, n_workers=n_workers)
+
+def append(filename, slabs, n_slabs, indices=(), updated_slabs=(), compression_level=None, n_workers=None):
+    """Append slabs to an existing Meta Image, optionally overwriting some of its slabs.
+
+    For chunked compressed data (see ``write``), chunks are copied without
+    decoding except the last one and the ones with overwritten slabs.
+    Other data is rewritten as a whole.
+
+    :param str filename: Image filename with extension mhd or mha.
+    :param iterable slabs: Arrays of shape ``(n,) + shape[1:]`` to be appended in order.
+    :param int n_slabs: The total number of slabs to be appended.
+    :param list [indices]: (optional) Indices of the slabs to be overwritten.
+    :param numpy.ndarray [updated_slabs]: (optional) New slabs for ``indices``.
+    :param int [compression_level]: (optional) zlib compression level (0-9).
+    :param int [n_workers]: (optional) Number of compression threads. Default: cpu count.
+    """
+    _rewrite(filename, dict(zip([int(z) for z in indices], updated_slabs)), slabs, n_slabs, compression_level, n_workers)
+
+_pyramid_max_size = 256 # the coarsest level built by default fits in this size
+
+def pyramid_filename(filename, level):
+    """Filename of a pyramid level of an image.
+
+    Pyramid levels are stored in ``<basename>.pyramid/`` next to the image.
+    Level 0 is the image itself.
+
+    :param str filename: Image filename with extension mhd or mha.
+    :param int level: Pyramid level.
+    :rtype: str
+    """
+    if level == 0:
+        return filename
+    return os.path.join(os.path.splitext(filename)[0] + '.pyramid', '{}.mha'.format(level))
+
+def _spatial_ndim(header):
+    return int(header['NDims'])
+
+def _downsample(block, spatial_ndim, label):
+    """Downsample a block of (at most) 2 slabs by 2 along every spatial axis.
+
+    Odd sized axes are padded by edge values.
+    """
+    pad = [(0, len(block) % 2 if len(block) > 1 else 1)] + [(0, n % 2) for n in block.shape[1:spatial_ndim]]
+    pad += [(0, 0)] * (block.ndim - spatial_ndim)
+    block = np.pad(block, pad, mode='edge')
+    shape = []
+    for n in block.shape[:spatial_ndim]:
+        shape += [n // 2, 2]
+    block = block.reshape(shape + list(block.shape[spatial_ndim:]))
+    pair_axes = tuple(range(1, 2 * spatial_ndim, 2))
+    if not label:
+        mean = block.mean(axis=pair_axes)
+        if np.issubdtype(block.dtype, np.integer):
+            mean = np.round(mean)
+        return mean.astype(block.dtype)
+    # mode of the 2**ndim values as the longest run of the sorted values (the smallest label on ties)
+    block = np.moveaxis(block, pair_axes, range(block.ndim - spatial_ndim, block.ndim))
+    values = np.sort(block.reshape(block.shape[:block.ndim - spatial_ndim] + (-1,)), axis=-1)
+    mode = values[..., 0].copy()
+    longest = np.ones(mode.shape, dtype=np.uint8)
+    run = np.ones(mode.shape, dtype=np.uint8)
+    for i in range(1, values.shape[-1]):
+        run += 1
+        run[values[..., i] != values[..., i-1]] = 1
+        longer = run > longest
+        mode[longer] = values[..., i][longer]
+        longest[longer] = run[longer]
+    return mode
+
+def _level_header(header, label):
+    h = copy.deepcopy(header)
+    spacing = np.atleast_1d(np.array(h.get('ElementSpacing', np.ones(_spatial_ndim(h))), dtype=float))
+    if 'Offset' in h:
+        ndim = len(spacing)
+        direction = np.array(h.get('TransformMatrix', np.eye(ndim).ravel()), dtype=float).reshape((ndim, ndim))
+        h['Offset'] = list(np.array(h['Offset'], dtype=float) + direction.T.dot(spacing / 2)) # center of 2x2(x2) block
+    h['ElementSpacing'] = list(spacing * 2)
+    h['PyramidReduction'] = 'mode' if label else 'mean'
+    return h
+
+def _is_level_up_to_date(filename, level, label):
+    level_filename = pyramid_filename(filename, level)
+    if not os.path.exists(level_filename):
+        return False
+    if os.path.getmtime(level_filename) < os.path.getmtime(pyramid_filename(filename, level - 1)):
+        return False
+    return read_header(level_filename).get('PyramidReduction') == ('mode' if label else 'mean')
+
+def _build_level(filename, level, label):
+    volume, header = read_lazy(pyramid_filename(filename, level - 1))
+    spatial_ndim = _spatial_ndim(header)
+    shape = tuple([(n + 1) // 2 for n in volume.shape[:spatial_ndim]]) + volume.shape[spatial_ndim:]
+    level_filename = pyramid_filename(filename, level)
+    os.makedirs(os.path.dirname(level_filename), exist_ok=True)
+    out = create_memmap(level_filename, shape, volume.dtype, _level_header(header, label))
+    for z, block in enumerate(volume.iter_slabs(2)):
+        out[z] = _downsample(block, spatial_ndim, label)[0]
+    out.flush()
+
+def build_pyramid(filename, n_levels=None, label=False):
+    """Build (or update) the pyramid of 2x downsampled levels of an image.
+
+    Each level is derived from the previous one by averaging 2x2(x2)
+    blocks, or by taking their mode for label images. Levels which are newer
+    than the previous level are kept as they are.
+
+    :param str filename: Image filename with extension mhd or mha.
+    :param int [n_levels]: (optional) The number of levels. Default: levels until the image fits in 256 voxels.
+    :param bool [label]: (optional) Downsample by mode instead of mean.
+    """
+    if n_levels is None:
+        header = read_header(filename)
+        size = max(_get_dim(header)[-_spatial_ndim(header):])
+        n_levels = 0
+        while size > _pyramid_max_size:
+            size = (size + 1) // 2
+            n_levels += 1
+    for level in range(1, n_levels + 1):
+        if not _is_level_up_to_date(filename, level, label):
+            _build_level(filename, level, label)
+
+def read_level(filename, level, label=False):
+    """Read a pyramid level of Meta Image.
+
+    Missing or outdated levels are (re)built first.
+
+    :param str filename: Image filename with extension mhd or mha.
+    :param int level: Pyramid level. Level 0 is the image itself.
+    :param bool [label]: (optional) The image is a label image.
+    :return: ND image and meta data.
+    :rtype: (numpy.ndarray, dict)
+    """
+    build_pyramid(filename, level, label)
+    return read(pyramid_filename(filename, level))
@@ -1,8 +1,455 @@
 import os
 import sys
 import argparse
+import contextlib
+import multiprocessing
 import vtk
+from vtk.util import numpy_support
 import tqdm
+import numpy as np
+from ssrvtools import mhd
+from ssrvtools import boundingbox as bb
+from ssrvtools.shared_array import SharedArray
+
+_writers = {'vtk':vtk.vtkPolyDataWriter,
+            'ply':vtk.vtkPLYWriter,
+            'stl':vtk.vtkSTLWriter
+}
+
+def to_image_data(array, spacing=None, origin=None, direction=None):
+    """Wrap a numpy array as vtkImageData.
+
+    A C-contiguous array is shared with VTK without a copy (other arrays,
+    e.g. cropped views, are copied into a contiguous array first). The
+    image keeps a reference to the array.
+
+    Args:
+        array (ndarray): Image of shape (z, y, x).
+        spacing (list): Voxel size in (x, y, z) order. Default: ones.
+        origin (list): Position of the first voxel in (x, y, z) order. Default: zeros.
+        direction (ndarray): 3x3 direction matrix, e.g. from ``direction_matrix``. Default: identity.
+    Returns:
+        vtk.vtkImageData: Image.
+    """
+    array = np.ascontiguousarray(array)
+    dims = list(array.shape[::-1]) + [1] * (3 - array.ndim)
+    image = vtk.vtkImageData()
+    image.SetDimensions(dims)
+    image.SetSpacing(_xyz(spacing, 1.0))
+    image.SetOrigin(_xyz(origin, 0.0))
+    if direction is not None:
+        image.SetDirectionMatrix(*np.asarray(direction, dtype=float).ravel())
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array.ravel(), deep=False)) # the vtk array refers to the numpy array
+    return image
+
+def direction_matrix(header):
+    """3x3 direction matrix of a Meta Image header, as vtkMetaImageReader reads ``TransformMatrix``.
+
+    Args:
+        header (dict): Meta data from ``mhd.read``.
+    Returns:
+        np.ndarray: Direction matrix. None if the header has no ``TransformMatrix``.
+    """
+    if 'TransformMatrix' not in header:
+        return None
+    values = np.atleast_1d(np.array(header['TransformMatrix'], dtype=float))
+    ndim = int(round(np.sqrt(len(values))))
+    direction = np.eye(3)
+    direction[:ndim,:ndim] = values.reshape((ndim, ndim))
+    return direction
+
+def _xyz(values, default):
+    values = [default] * 3 if values is None else [float(v) for v in np.atleast_1d(values)]
+    return values + [default] * (3 - len(values))
+
+def _contour(image, labels):
+    """Extract surfaces of labels tagged with the label as cell scalars."""
+    contour = vtk.vtkDiscreteMarchingCubes()
+    contour.SetInputData(image)
+    contour.ComputeNormalsOff()
+    for i, label in enumerate(labels):
+        contour.SetValue(i, label)
+    contour.Update()
+    return contour.GetOutput()
+
+def _decimate(polydata, reduce):
+    decimate = vtk.vtkQuadricDecimation()
+    decimate.SetInputData(polydata)
+    decimate.SetTargetReduction(reduce)
+    decimate.Update()
+    return decimate.GetOutput()
+
+def _smooth(polydata, smooth):
+    """Smooth a surface and compute its normals."""
+    smoother= vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputData(polydata)
+    smoother.SetNumberOfIterations(smooth)
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    smoother.Update()
+
+    normals= vtk.vtkPolyDataNormals()
+    normals.SetInputData(smoother.GetOutput())
+    normals.ComputePointNormalsOn()
+    normals.ComputeCellNormalsOff()
+    normals.SplittingOff()
+    normals.ConsistencyOn()
+    normals.Update()
+    return normals.GetOutput()
+
+def _simplify(polydata, reduce, smooth):
+    """Decimate and smooth a surface and compute its normals."""
+    return _smooth(_decimate(polydata, reduce), smooth)
+
+def _simplify_levels(polydata, reductions, smooth):
+    """Simplify a surface into levels of detail.
+
+    Each level is decimated from the (unsmoothed) previous one rather than
+    from the full surface.
+
+    Returns:
+        list: Surfaces in the order of sorted reductions, i.e. the most detailed first.
+    """
+    levels = []
+    reduced = 0.0
+    for reduce in sorted(reductions):
+        polydata = _decimate(polydata, 1 - (1 - reduce) / (1 - reduced))
+        reduced = reduce
+        levels.append(_smooth(polydata, smooth))
+    return levels
+
+def _split_by_label(polydata):
+    """Split a triangle mesh by its cell scalars.
+
+    Points of each piece are numbered in the order of first use, as
+    marching cubes of the label alone would number them.
+
+    Returns:
+        dict: (points, triangles) keyed by labels.
+    """
+    if polydata.GetNumberOfPolys() == 0:
+        return {}
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    triangles = numpy_support.vtk_to_numpy(polydata.GetPolys().GetConnectivityArray()).reshape((-1,3))
+    scalars = numpy_support.vtk_to_numpy(polydata.GetCellData().GetScalars()).astype(np.int64)
+    order = np.argsort(scalars, kind='stable')
+    labels, starts = np.unique(scalars[order], return_index=True)
+    pieces = {}
+    for label, start, stop in zip(labels, starts, list(starts[1:]) + [len(order)]):
+        piece = triangles[order[start:stop]]
+        ids, first = np.unique(piece, return_index=True)
+        used = ids[np.argsort(first)]
+        new_ids = np.empty(used.max() + 1, dtype=np.int64)
+        new_ids[used] = np.arange(len(used))
+        pieces[int(label)] = (points[used], new_ids[piece])
+    return pieces
+
+def _to_polydata(points, triangles):
+    polydata = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points), deep=True))
+    polydata.SetPoints(vtk_points)
+    cells = vtk.vtkCellArray()
+    offsets = np.arange(0, 3 * len(triangles) + 1, 3, dtype=np.int64)
+    cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                  numpy_support.numpy_to_vtkIdTypeArray(np.ascontiguousarray(triangles, dtype=np.int64).ravel(), deep=True))
+    polydata.SetPolys(cells)
+    return polydata
+
+def _to_arrays(polydata):
+    """Points, triangles and point normals of a surface. None if empty."""
+    if polydata.GetNumberOfPolys() == 0:
+        return None
+    return (numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()),
+            numpy_support.vtk_to_numpy(polydata.GetPolys().GetConnectivityArray()).reshape((-1,3)),
+            numpy_support.vtk_to_numpy(polydata.GetPointData().GetNormals()))
+
+def _from_arrays(points, triangles, normals):
+    polydata = _to_polydata(points, triangles)
+    vtk_normals = numpy_support.numpy_to_vtk(normals, deep=True)
+    vtk_normals.SetName('Normals')
+    polydata.GetPointData().SetNormals(vtk_normals)
+    return polydata
+
+def _write(filename, ext, polydata):
+    writer = _writers[ext]()
+    writer.SetFileTypeToBinary()
+    writer.SetFileName(filename)
+    writer.SetInputData(polydata)
+    writer.Write()
+
+class _PieceMesher(object):
+    """Simplify a piece of a multi-label surface and write it into a file or return its arrays."""
+    def __init__(self, output_format, ext, reduce, smooth, combined=False):
+        self.output_format = output_format
+        self.ext = ext
+        self.reduce = reduce
+        self.smooth = smooth
+        self.combined = combined
+    def __call__(self, args):
+        label, piece = args
+        polydata = vtk.vtkPolyData() if piece is None else _simplify(_to_polydata(*piece), self.reduce, self.smooth)
+        if self.combined:
+            return label, _to_arrays(polydata)
+        filename = self.output_format.format(label)
+        _write(filename, self.ext, polydata)
+        return label, filename
+
+def _combine(meshes):
+    """Append meshes into one polydata with a 'label' cell array."""
+    append = vtk.vtkAppendPolyData()
+    for label, (points, triangles, normals) in sorted(meshes.items()):
+        polydata = _from_arrays(points, triangles, normals)
+        label_array = numpy_support.numpy_to_vtk(np.full(len(triangles), label, dtype=np.int32), deep=True)
+        label_array.SetName('label')
+        polydata.GetCellData().AddArray(label_array)
+        append.AddInputData(polydata)
+    append.Update()
+    return append.GetOutput()
+
+def mesh_label(volume, label, spacing=None, origin=None, reduce=0.9, smooth=10, cap=False, bbox=None, direction=None):
+    """Extract, decimate and smooth the surface of a label.
+
+    Only the bounding box of the label (with one voxel margin) is meshed,
+    so ``volume`` can be a memory-map or any array view.
+
+    Args:
+        volume (ndarray): Label image of shape (z, y, x).
+        label (int): Label.
+        spacing (list): Voxel size in (x, y, z) order. Default: ones.
+        origin (list): Position of the first voxel in (x, y, z) order. Default: zeros.
+        reduce (float): Target reduction rate of decimation.
+        smooth (int): The number of smoothing iterations.
+        cap (bool): Close the surface on the image border.
+        bbox (np.array, np.array): Bounding box of the label, e.g. from ``boundingbox.label_bboxes``. Computed if None.
+        direction (ndarray): 3x3 direction matrix, e.g. from ``direction_matrix``. Default: identity.
+    Returns:
+        vtk.vtkPolyData: Surface with point normals. Empty if the label is not in the volume.
+    """
+    surface = _label_surface(volume, label, spacing, origin, cap, bbox, direction)
+    return vtk.vtkPolyData() if surface is None else _simplify(surface, reduce, smooth)
+
+def mesh_label_levels(volume, label, reductions, spacing=None, origin=None, smooth=10, cap=False, bbox=None, direction=None):
+    """Extract the surface of a label and simplify it into levels of detail.
+
+    The marching cubes output is computed once and shared by all levels.
+    Arguments are the same as ``mesh_label`` except for ``reductions``.
+
+    Args:
+        reductions (list): Target reduction rates of the levels.
+    Returns:
+        list: vtk.vtkPolyData in the order of sorted reductions (the most detailed first).
+    """
+    surface = _label_surface(volume, label, spacing, origin, cap, bbox, direction)
+    if surface is None:
+        return [vtk.vtkPolyData() for _ in reductions]
+    return _simplify_levels(surface, reductions, smooth)
+
+def _label_surface(volume, label, spacing, origin, cap, bbox, direction=None):
+    """Marching cubes output of a label within its bounding box. None if the label is not in the volume."""
+    if bbox is None:
+        mask = volume == label
+        if not np.any(mask):
+            return None
+        bbox = bb.bbox(mask)
+    # one voxel margin keeps all marching cubes cells touching the label
+    slices = bb._crop_slices(volume.shape, bbox, 1)
+    sub = volume[slices]
+    start = np.array([s.start for s in slices])
+    if cap:
+        # pad only where the margin is cut by the volume border, as the whole volume would be padded
+        before = [1 if s.start == 0 else 0 for s in slices]
+        after = [1 if s.stop == n else 0 for s, n in zip(slices, volume.shape)]
+        sub = np.pad(sub, list(zip(before, after)), 'constant')
+        start = start - before
+    spacing = _xyz(spacing, 1.0)
+    return _contour(to_image_data(sub, spacing, _shifted_origin(origin, spacing, direction, start), direction), [label])
+
+def _shifted_origin(origin, spacing, direction, start):
+    """Position of the voxel at index ``start`` (in (z, y, x) order)."""
+    offset = np.zeros(3)
+    offset[:len(start)] = np.asarray(start)[::-1] * np.array(spacing[:len(start)])
+    if direction is not None:
+        offset = np.asarray(direction, dtype=float).dot(offset)
+    return np.array(_xyz(origin, 0.0)) + offset
+
+def mesh_labels(volume, spacing=None, origin=None, labels=None, reduce=0.9, smooth=10, cap=False, single_pass=False, direction=None):
+    """Extract, decimate and smooth the surfaces of labels.
+
+    Args:
+        volume (ndarray): Label image of shape (z, y, x).
+        spacing (list): Voxel size in (x, y, z) order. Default: ones.
+        origin (list): Position of the first voxel in (x, y, z) order. Default: zeros.
+        labels (list): Labels to mesh. Default: 1 to the max label.
+        reduce (float): Target reduction rate of decimation.
+        smooth (int): The number of smoothing iterations.
+        cap (bool): Close the surfaces on the image border.
+        single_pass (bool): Extract all surfaces at once instead of per label bounding box.
+        direction (ndarray): 3x3 direction matrix, e.g. from ``direction_matrix``. Default: identity.
+    Returns:
+        dict: vtk.vtkPolyData keyed by labels.
+    """
+    if labels is None:
+        labels = range(1, int(np.max(volume)) + 1)
+    if single_pass:
+        pieces = _contour_pieces(volume, spacing, origin, labels, cap, direction)
+        return {label: _simplify(_to_polydata(*pieces[label]), reduce, smooth) if label in pieces else vtk.vtkPolyData() for label in labels}
+    bboxes = bb.label_bboxes(volume)
+    return {label: mesh_label(volume, label, spacing, origin, reduce, smooth, cap, bboxes[label], direction) if label in bboxes else vtk.vtkPolyData() for label in labels}
+
+def _contour_pieces(volume, spacing, origin, labels, cap, direction=None):
+    spacing = _xyz(spacing, 1.0)
+    if cap:
+        volume = np.pad(volume, 1, 'constant')
+        origin = _shifted_origin(origin, spacing, direction, [-1] * volume.ndim)
+    return _split_by_label(_contour(to_image_data(volume, spacing, origin, direction), labels))
+
+def write_polydata(filename, polydata):
+    """Write polydata into a file of type given by the extension (vtk, ply or stl)."""
+    _write(filename, os.path.splitext(filename)[1][1:], polydata)
+
+class _LabelMesher(object):
+    """Mesh a label within its bounding box and write it into a file.
+
+    Tasks are (label, bbox) with bbox None for labels not in the volume.
+    """
+    def __init__(self, volume, spacing, origin, direction, output_format, ext, reduce, smooth, cap):
+        self.volume = volume
+        self.spacing = spacing
+        self.origin = origin
+        self.direction = direction
+        self.output_format = output_format
+        self.ext = ext
+        self.reduce = reduce
+        self.smooth = smooth
+        self.cap = cap
+    def __call__(self, args):
+        label, bbox = args
+        if bbox is not None:
+            polydata = mesh_label(self.volume.array, label, self.spacing, self.origin, self.reduce, self.smooth, self.cap, bbox, self.direction)
+        else:
+            polydata = vtk.vtkPolyData()
+        filename = self.output_format.format(label)
+        _write(filename, self.ext, polydata)
+        return filename
+
+class _LevelMesher(object):
+    """Simplify the surface of a label into levels of detail and return their arrays.
+
+    Tasks are (label, piece, bbox) with either the piece of the single pass
+    surface or the bounding box of the label in the volume. Both are None
+    for labels not in the volume.
+    """
+    def __init__(self, volume, spacing, origin, direction, reductions, smooth, cap):
+        self.volume = volume
+        self.spacing = spacing
+        self.origin = origin
+        self.direction = direction
+        self.reductions = reductions
+        self.smooth = smooth
+        self.cap = cap
+    def __call__(self, args):
+        label, piece, bbox = args
+        if piece is not None:
+            levels = _simplify_levels(_to_polydata(*piece), self.reductions, self.smooth)
+        elif bbox is not None:
+            levels = mesh_label_levels(self.volume.array, label, self.reductions, self.spacing, self.origin, self.smooth, self.cap, bbox, self.direction)
+        else:
+            return label, [None] * len(self.reductions)
+        return label, [_to_arrays(polydata) for polydata in levels]
+
+def _write_levels(filename, reductions, meshes):
+    """Write levels of detail into a multiblock file (vtm) of zlib compressed vtp files.
+
+    Top level blocks are the levels, the lightest first, and each of them
+    has a block per label. Labels without surface are left out.
+    """
+    reductions = sorted(reductions)
+    multiblock = vtk.vtkMultiBlockDataSet()
+    for i, level in enumerate(reversed(range(len(reductions)))):
+        block = vtk.vtkMultiBlockDataSet()
+        labels = [label for label in sorted(meshes) if meshes[label][level] is not None]
+        for j, label in enumerate(labels):
+            block.SetBlock(j, _from_arrays(*meshes[label][level]))
+            block.GetMetaData(j).Set(vtk.vtkCompositeDataSet.NAME(), 'label_{}'.format(label))
+        multiblock.SetBlock(i, block)
+        multiblock.GetMetaData(i).Set(vtk.vtkCompositeDataSet.NAME(), 'reduce_{}'.format(reductions[level]))
+    writer = vtk.vtkXMLMultiBlockDataWriter()
+    writer.SetFileName(filename)
+    writer.SetInputData(multiblock)
+    writer.SetCompressorTypeToZLib()
+    writer.SetDataModeToBinary()
+    writer.Write()
+
+def _run(func, tasks, processes):
+    if processes == 1:
+        return list(tqdm.tqdm(map(func, tasks), total=len(tasks)))
+    with multiprocessing.Pool(processes=processes) as pool:
+        return list(tqdm.tqdm(pool.imap_unordered(func, tasks), total=len(tasks)))
+
+@contextlib.contextmanager
+def _shared(volume):
+    """Share the volume with worker processes, copying it into shared memory unless it is there already."""
+    if isinstance(volume, SharedArray):
+        yield volume
+        return
+    with SharedArray(volume.shape, volume.dtype) as shared:
+        shared.array[:] = volume
+        yield shared
+
+def convert(volume, output_format, spacing=None, origin=None, ext='vtk', reduce=0.9, smooth=10, cap=False, single_pass=False, combined_filename=None, processes=None, lod=None, lod_filename=None, direction=None):
+    """Mesh labels in worker processes and write them into files.
+
+    Args:
+        volume (ndarray or SharedArray): Label image of shape (z, y, x). An ndarray is copied into shared memory
+            for the workers unless meshed in a single pass, so pass a SharedArray to avoid the copy.
+        output_format (str): Output filename format taking a label, e.g. 'label_{}.vtk'.
+        spacing (list): Voxel size in (x, y, z) order. Default: ones.
+        origin (list): Position of the first voxel in (x, y, z) order. Default: zeros.
+        ext (str): File type (vtk, ply or stl).
+        reduce (float): Target reduction rate of decimation.
+        smooth (int): The number of smoothing iterations.
+        cap (bool): Close the surfaces on the image border.
+        single_pass (bool): Extract all surfaces at once instead of per label bounding box.
+        combined_filename (str): Write all labels into this file with a 'label' cell array instead (implies single_pass).
+        processes (int): Number of worker processes. Default: cpu count.
+        lod (list): Write levels of detail with these reduction rates into ``lod_filename`` (vtm) instead.
+        lod_filename (str): Multiblock filename for levels of detail.
+        direction (ndarray): 3x3 direction matrix, e.g. from ``direction_matrix``. Default: identity.
+    """
+    if ext not in _writers:
+        raise ValueError('Unknown file type:'+ext)
+    array = volume.array if isinstance(volume, SharedArray) else volume
+    labels = range(1, int(np.max(array)) + 1)
+    processes = processes or multiprocessing.cpu_count()
+
+    if lod:
+        if not all(0 <= r < 1 for r in lod):
+            raise ValueError('Reduction rates must be in [0, 1).')
+        if single_pass:
+            pieces = _contour_pieces(array, spacing, origin, labels, cap, direction)
+            tasks = [(label, pieces.get(label), None) for label in labels]
+            results = _run(_LevelMesher(None, spacing, origin, direction, lod, smooth, cap), tasks, processes)
+        else:
+            bboxes = bb.label_bboxes(array)
+            with _shared(volume) as shared:
+                tasks = [(label, None, bboxes.get(label)) for label in labels]
+                results = _run(_LevelMesher(shared, spacing, origin, direction, lod, smooth, cap), tasks, processes)
+        _write_levels(lod_filename, lod, dict(results))
+        return
+
+    if single_pass or combined_filename is not None:
+        pieces = _contour_pieces(array, spacing, origin, labels, cap, direction)
+        mesher = _PieceMesher(output_format, ext, reduce, smooth, combined_filename is not None)
+        results = _run(mesher, [(label, pieces.get(label)) for label in labels], processes)
+        if combined_filename is not None:
+            _write(combined_filename, ext, _combine({label: mesh for label, mesh in results if mesh is not None}))
+        return
+
+    bboxes = bb.label_bboxes(array)
+    with _shared(volume) as shared:
+        tasks = [(label, bboxes.get(label)) for label in labels]
+        _run(_LabelMesher(shared, spacing, origin, direction, output_format, ext, reduce, smooth, cap), tasks, processes)
 
 def main():
     parser = argparse.ArgumentParser(description='Convert label image into polygon mesh files.')
@@ -12,63 +459,31 @@ def main():
     parser.add_argument('--reduce', help='Target reduction rate. Default:%(default)s',metavar='<rate>',default=0.9,type=float)
     parser.add_argument('--smooth', help='# of iteration for smoothing. Default:%(default)s',metavar='<n>',default=10,type=int)
     parser.add_argument('--cap', help="Cap on the image border",action='store_true')
-
+    parser.add_argument('--n_workers', help='Number of worker processes. Default: cpu count',metavar='<n>',type=int)
+    parser.add_argument('--single_pass', help='Extract surfaces of all labels at once and split them by label instead of per label',action='store_true')
+    parser.add_argument('--combined', help='Write all labels into one file <output>.<ext> with a "label" cell array (implies --single_pass)',action='store_true')
+    parser.add_argument('--lod', help='Write levels of detail with these target reduction rates into <output>.vtm (multiblock of compressed vtp files) instead',metavar='<rate>',type=float,nargs='+')
 
     args = parser.parse_args()
 
+    if args.ext not in _writers:
+        print('Unknown file type:'+args.ext)
+        sys.exit(1)
+    if args.lod and args.combined:
+        parser.error('--lod cannot be used with --combined')
+    if args.lod and args.ext != parser.get_default('ext'):
+        parser.error('--lod writes vtp files and cannot be used with --ext')
+    output_base = os.path.splitext(args.input if args.output is None else args.output)[0]
     if args.output is None:
-        output_format = os.path.splitext(os.path.basename(args.input))[0] + '_{}.' + args.ext
-    reader = vtk.vtkMetaImageReader()
-    reader.SetFileName(args.input)
-    reader.Update()
-    n_labels = int(reader.GetOutput().GetScalarRange()[1])
-
-    contour = vtk.vtkDiscreteMarchingCubes()
-    if args.cap:
-        padder = vtk.vtkImageConstantPad()
-        padder.SetInputConnection(reader.GetOutputPort())
-        padder.SetConstant(0)
-        extent = reader.GetOutput().GetExtent()
-        padder.SetOutputWholeExtent(-1, extent[1]+1, -1, extent[3]+1, -1, extent[5]+1)
-        contour.SetInputConnection(padder.GetOutputPort())
-    else:
-        contour.SetInputConnection(reader.GetOutputPort())
-    contour.ComputeNormalsOff()
-
-    writer = {'vtk':vtk.vtkPolyDataWriter,
-              'ply':vtk.vtkPLYWriter,
-              'stl':vtk.vtkSTLWriter
-    }.get(args.ext, lambda : (print('Unknown file type:'+args.ext), sys.exit(1)))()
-    writer.SetFileTypeToBinary()
+        output_base = os.path.basename(output_base)
 
-    for index in tqdm.trange(1, n_labels + 1):
-        contour.SetValue(0, index)
-        contour.Update()
-
-        decimate = vtk.vtkQuadricDecimation()
-        decimate.SetInputConnection(contour.GetOutputPort())
-        decimate.SetTargetReduction(args.reduce)
-        decimate.Update()
-
-        smoother= vtk.vtkWindowedSincPolyDataFilter()
-        smoother.SetInputConnection(decimate.GetOutputPort())
-        smoother.SetNumberOfIterations(args.smooth)
-        smoother.NonManifoldSmoothingOn()
-        smoother.NormalizeCoordinatesOn()
-        smoother.Update()
-
-        normals= vtk.vtkPolyDataNormals()
-        normals.SetInputData(smoother.GetOutput())
-        normals.ComputePointNormalsOn()
-        normals.ComputeCellNormalsOff()
-        normals.SplittingOff()
-        normals.ConsistencyOn()
-        normals.Update()
-
-
-        writer.SetFileName(output_format.format(index))
-        writer.SetInputData(normals.GetOutput())
-        writer.Write()
+    lazy, header = mhd.read_lazy(args.input) # shape and dtype
+    with SharedArray(lazy.shape, lazy.dtype) as image: # read straight into the memory shared with the workers
+        mhd.read(args.input, image.array)
+        convert(image, output_base + '_{}.' + args.ext, header.get('ElementSpacing'), header.get('Offset'), args.ext,
+                args.reduce, args.smooth, args.cap, args.single_pass,
+                output_base + '.' + args.ext if args.combined else None, args.n_workers,
+                args.lod, output_base + '.vtm', direction_matrix(header))
 
 if __name__ == "__main__":
     main()
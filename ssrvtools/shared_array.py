@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import collections
+import numpy as np
+from multiprocessing import shared_memory
+
+def bounded_imap(pool, func, iterable, n_inflight):
+    """Ordered ``pool.imap`` which keeps at most ``n_inflight`` results in flight.
+
+    Unlike ``pool.imap``, items are taken from ``iterable`` only as results
+    are consumed, so a lazily read input is not loaded ahead at once.
+
+    Args:
+        pool (multiprocessing.pool.Pool): Process pool.
+        func (callable): Function taking one item.
+        iterable (iterable): Items.
+        n_inflight (int): The maximum number of items submitted but not yet consumed.
+    Returns:
+        Generator of the results in order.
+    """
+    results = collections.deque()
+    for item in iterable:
+        results.append(pool.apply_async(func, (item,)))
+        if len(results) >= n_inflight:
+            yield results.popleft().get()
+    while results:
+        yield results.popleft().get()
+
+class SharedArray(object):
+    """numpy array on shared memory.
+
+    A SharedArray is pickled as the name of its shared memory block, so
+    passing it to pool workers attaches the workers to the same memory
+    instead of copying the data. The block is released when the creating
+    instance is closed or garbage collected.
+
+    Args:
+        shape (tuple): Shape of the array.
+        dtype: Data type of the array.
+        name (str): Name of an existing block to attach to. A new block is created if None.
+    """
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            nbytes = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return self.shape, self.dtype.str, self.shm.name
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Detach from the shared memory, and free it if this instance created it."""
+        if getattr(self, 'array', None) is None:
+            return
+        self.array = None # release the buffer before closing
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()